@@ -0,0 +1,94 @@
+import asyncio
+import websockets
+import argparse
+import time
+import sys
+import server
+
+# Checks that rooms don't wait on each other: while the lock of one room is held (like it is while a slow command runs in it), messages in another room and room list refreshes in the lobby still have to go through.
+# Runs the server in this process so that it can hold the lock itself. Exits with 1 if anything got stuck.
+
+async def receive(websocket, prefix, timeout):
+	deadline = time.perf_counter() + timeout
+	while True:
+		message = await asyncio.wait_for(websocket.recv(), max(0, deadline - time.perf_counter()))
+		if message.startswith(prefix):
+			return message
+
+async def connect(options, userID):
+	websocket = await websockets.connect("ws://" + options.host + ":" + str(options.port))
+	await websocket.send("[iam]" + userID)
+	return websocket
+
+async def join(websocket, room):
+	await websocket.send("[join]" + str(room.id))
+	await receive(websocket, "jnd:", 5)
+
+async def runContentionTest(options):
+	server.backplane = server.LocalBackplane()
+	for name in ("Room A", "Room B"):
+		await server.createNewRoom(name, 0, "U-ContentionTest", bySystem = True)
+	roomA, roomB = list(server.rooms.values())[-2:]
+	websocketServer = await websockets.serve(server.takeClient, options.host, options.port)
+	failures = []
+	try:
+		senderA = await connect(options, "U-SenderA")
+		senderB = await connect(options, "U-SenderB")
+		lobby = await connect(options, "U-Lobby")
+		await join(senderA, roomA)
+		await join(senderB, roomB)
+		
+		async with roomA.lock:
+			# this one can't get through until the lock is released
+			await senderA.send("[message]stuck in room A")
+			for number in range(options.messages):
+				start = time.perf_counter()
+				await senderB.send("[message]room B " + str(number))
+				try:
+					await receive(senderB, "msg:U-SenderB", options.timeout)
+					print("room B message " + str(number) + ": " + format((time.perf_counter() - start) * 1000, ".2f") + "ms")
+				except asyncio.TimeoutError:
+					failures.append("A message in room B got stuck while room A was locked.")
+					break
+			start = time.perf_counter()
+			await lobby.send("[refresh]")
+			try:
+				await receive(lobby, "rom:", options.timeout)
+				print("lobby refresh: " + format((time.perf_counter() - start) * 1000, ".2f") + "ms")
+			except asyncio.TimeoutError:
+				failures.append("A room list refresh got stuck while room A was locked.")
+			try:
+				await receive(senderA, "msg:U-SenderA", 0.2)
+				failures.append("The message in room A went through even though the room was locked.")
+			except asyncio.TimeoutError:
+				pass
+		
+		# and once it is released, room A carries on
+		try:
+			await receive(senderA, "msg:U-SenderA", options.timeout)
+		except asyncio.TimeoutError:
+			failures.append("The message in room A didn't go through after the lock was released.")
+		for websocket in (senderA, senderB, lobby):
+			await websocket.close()
+	finally:
+		websocketServer.close()
+		await websocketServer.wait_closed()
+	return failures
+
+def main():
+	parser = argparse.ArgumentParser(description = "Checks that a locked room doesn't hold up other rooms or the lobby.")
+	parser.add_argument("--messages", type = int, default = 5, help = "how many messages to send in the other room while the first one is locked")
+	parser.add_argument("--timeout", type = float, default = 2, help = "how many seconds a message or refresh may take before it counts as stuck")
+	parser.add_argument("--host", default = "localhost")
+	parser.add_argument("--port", type = int, default = 32763)
+	options = parser.parse_args()
+	
+	failures = asyncio.run(runContentionTest(options))
+	for failure in failures:
+		print(failure)
+	if len(failures) > 0:
+		sys.exit(1)
+	print("Rooms made progress independently.")
+
+if __name__ == "__main__":
+	main()
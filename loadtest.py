@@ -0,0 +1,293 @@
+import asyncio
+import websockets
+import argparse
+import subprocess
+import tempfile
+import shutil
+import random
+import time
+import json
+import sys
+import os
+
+# Starts the server locally (or connects to one that's already running) and throws lots of synthetic clients at it.
+# The clients speak the same protocol as the real facet and the results get written as JSON so that runs against different versions can be compared.
+
+serverDirectory = os.path.dirname(os.path.abspath(__file__))
+
+# one synthetic client.
+class LoadClient:
+	def __init__(self, number, options, report):
+		self.number = number
+		self.options = options
+		self.report = report
+		self.userID = "U-LoadTest" + str(number)
+		self.websocket = None
+		self.room = None
+		self.joinSent = None
+		self.joined = asyncio.Event()
+		self.rooms = [] # room IDs from the rom: messages the server sent
+	
+	async def connect(self):
+		self.websocket = await websockets.connect("ws://" + self.options.host + ":" + str(self.options.port), max_size = None)
+		self.reader = asyncio.ensure_future(self.read())
+		await self.websocket.send("[iam]" + self.userID)
+	
+	async def read(self):
+		try:
+			async for message in self.websocket:
+				receivedAt = time.perf_counter()
+				self.report["framesReceived"] += 1
+				if message.startswith("msg:"):
+					# messages from the load test have the client number and message number in them
+					marker = message.find("lt:")
+					if marker >= 0:
+						token = message[marker + 3:message.find(":", marker + 3)]
+						arrivals = self.report["arrivals"].get(token)
+						if arrivals is not None:
+							arrivals.append(receivedAt)
+				elif message.startswith("rom:"):
+					self.rooms.append(int(message[4:message.find("|")]))
+				elif message.startswith("jnd:"):
+					if self.joinSent is not None:
+						self.report["joinLatencies"].append(receivedAt - self.joinSent)
+						self.joinSent = None
+					self.joined.set()
+				elif message.startswith("err:"):
+					self.report["errors"] += 1
+		except websockets.exceptions.ConnectionClosed:
+			self.report["disconnects"] += 1
+	
+	async def join(self, room):
+		self.room = room
+		self.joined.clear()
+		self.joinSent = time.perf_counter()
+		await self.websocket.send("[join]" + str(room) + "|" + str(self.options.history))
+		await asyncio.wait_for(self.joined.wait(), 30)
+	
+	# sends messages (and now and then something else) until the deadline.
+	async def chat(self, deadline):
+		messageNumber = 0
+		interval = 1 / self.options.rate
+		# start at a random point so that not all clients send at once
+		await asyncio.sleep(random.uniform(0, interval))
+		while time.perf_counter() < deadline:
+			roll = random.random()
+			if roll < self.options.refresh_share:
+				await self.websocket.send("[refresh]")
+			elif roll < self.options.refresh_share + self.options.command_share:
+				await self.websocket.send("[message]/video https://example.com/" + str(messageNumber))
+			else:
+				messageNumber += 1
+				token = str(self.number) + "-" + str(messageNumber)
+				self.report["arrivals"][token] = []
+				self.report["sent"][token] = (time.perf_counter(), self.room)
+				await self.websocket.send("[message]lt:" + token + ": " + random.choice(self.options.corpus))
+			await asyncio.sleep(interval)
+	
+	async def leave(self):
+		await self.websocket.send("[leave]")
+	
+	async def close(self):
+		await self.websocket.close()
+		self.reader.cancel()
+
+corpus = [
+	"hello everyone",
+	"has anyone seen the new logix nodes? :o:",
+	"[b]important:[/b] meeting in 5 :cool:",
+	"lol :xd: :xd: :xd:",
+	"this message is a bit longer than the others because some people like to write whole paragraphs in chat, even in VR " * 3
+]
+
+def percentile(values, fraction):
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(values):
+	return {
+		"count": len(values),
+		"p50": percentile(values, 0.5),
+		"p95": percentile(values, 0.95),
+		"p99": percentile(values, 0.99),
+		"max": max(values) if len(values) > 0 else None
+	}
+
+# returns the resident memory (in bytes) of a process and all of its children. (Linux only, None elsewhere)
+def residentMemory(pid):
+	try:
+		total = 0
+		with open("/proc/" + str(pid) + "/status") as status:
+			for line in status:
+				if line.startswith("VmRSS:"):
+					total += int(line.split()[1]) * 1024
+		for task in os.listdir("/proc/" + str(pid) + "/task"):
+			with open("/proc/" + str(pid) + "/task/" + task + "/children") as children:
+				for child in children.read().split():
+					total += residentMemory(int(child)) or 0
+		return total
+	except OSError:
+		return None
+
+def serverVersion():
+	try:
+		return subprocess.run(["git", "describe", "--always", "--dirty"], cwd = serverDirectory, capture_output = True, text = True).stdout.strip() or None
+	except OSError:
+		return None
+
+# starts server.py in a temporary directory so that the real rooms.json doesn't get touched.
+# arguments get passed on to the server and rooms is the rooms.json to start it with (defaults to the one next to server.py).
+def startServer(options, arguments = [], rooms = None):
+	workingDirectory = tempfile.mkdtemp()
+	shutil.copy(rooms or os.path.join(serverDirectory, "rooms.json"), os.path.join(workingDirectory, "rooms.json"))
+	server = subprocess.Popen([sys.executable, os.path.join(serverDirectory, "server.py"), "--host", options.host, "--port", str(options.port), "--workers", str(options.workers)] + arguments, cwd = workingDirectory, stdout = subprocess.DEVNULL)
+	return server, workingDirectory
+
+# thousands of clients need more file descriptors than the default
+def raiseFileLimit():
+	try:
+		import resource
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	except (ImportError, ValueError, OSError):
+		pass
+
+async def waitForServer(options):
+	for attempt in range(100):
+		try:
+			websocket = await websockets.connect("ws://" + options.host + ":" + str(options.port))
+			await websocket.close()
+			return
+		except OSError:
+			await asyncio.sleep(0.1)
+	raise RuntimeError("The server did not start.")
+
+async def runLoadTest(options, serverPid):
+	report = {"framesReceived": 0, "errors": 0, "disconnects": 0, "joinLatencies": [], "arrivals": {}, "sent": {}}
+	baseMemory = residentMemory(serverPid) if serverPid else None
+	
+	# connect everyone (a few at a time so that the test doesn't just measure the accept backlog)
+	clients = [LoadClient(number, options, report) for number in range(options.clients)]
+	connectSlots = asyncio.Semaphore(options.connect_concurrency)
+	async def connect(client):
+		async with connectSlots:
+			await client.connect()
+	await asyncio.gather(*(connect(client) for client in clients))
+	await asyncio.sleep(0.5)
+	
+	# spread the clients across the rooms they were told about
+	rooms = sorted(set(clients[0].rooms))
+	if options.rooms:
+		rooms = rooms[:options.rooms]
+	await asyncio.gather(*(client.join(rooms[client.number % len(rooms)]) for client in clients))
+	connectedMemory = residentMemory(serverPid) if serverPid else None
+	roomSizes = {room: sum(1 for client in clients if client.room == room) for room in rooms}
+	
+	# chat for a while
+	start = time.perf_counter()
+	await asyncio.gather(*(client.chat(start + options.duration) for client in clients))
+	chatTime = time.perf_counter() - start
+	# give the last messages a moment to arrive
+	await asyncio.sleep(options.drain)
+	
+	for client in clients:
+		await client.leave()
+	await asyncio.sleep(0.2)
+	for client in clients:
+		await client.close()
+	
+	# a message has fanned out once the last user in its room got it
+	fanOutLatencies = []
+	incomplete = 0
+	for token, (sentAt, room) in report["sent"].items():
+		arrivals = report["arrivals"][token]
+		if len(arrivals) < roomSizes[room]:
+			incomplete += 1
+		elif len(arrivals) > 0:
+			fanOutLatencies.append(max(arrivals) - sentAt)
+	
+	return {
+		"version": serverVersion(),
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		"config": {
+			"clients": options.clients,
+			"rooms": len(rooms),
+			"workers": options.workers,
+			"duration": options.duration,
+			"rate": options.rate,
+			"history": options.history
+		},
+		"results": {
+			"messagesSent": len(report["sent"]),
+			"messagesPerSecond": len(report["sent"]) / chatTime,
+			"framesReceived": report["framesReceived"],
+			"framesReceivedPerSecond": report["framesReceived"] / chatTime,
+			"incompleteFanOuts": incomplete,
+			"errors": report["errors"],
+			"disconnects": report["disconnects"],
+			"fanOutLatency": summarize(fanOutLatencies),
+			"joinLatency": summarize(report["joinLatencies"]),
+			"memoryPerConnection": (connectedMemory - baseMemory) / options.clients if baseMemory and connectedMemory else None
+		}
+	}
+
+# prints how the results of this run differ from an earlier one.
+def compare(results, baseline, latencies = ("fanOutLatency", "joinLatency"), values = ("messagesPerSecond", "memoryPerConnection")):
+	for section in latencies:
+		for key in ("p50", "p95", "p99"):
+			old = baseline["results"][section][key]
+			new = results["results"][section][key]
+			if old and new:
+				print(section + " " + key + ": " + format(old * 1000, ".2f") + "ms -> " + format(new * 1000, ".2f") + "ms (" + format((new / old - 1) * 100, "+.1f") + "%)")
+	for key in values:
+		old = baseline["results"][key]
+		new = results["results"][key]
+		if old and new:
+			print(key + ": " + format(old, ".1f") + " -> " + format(new, ".1f") + " (" + format((new / old - 1) * 100, "+.1f") + "%)")
+
+def main():
+	parser = argparse.ArgumentParser(description = "Load test for the nChat server.")
+	parser.add_argument("--clients", type = int, default = 200, help = "how many clients to connect")
+	parser.add_argument("--rooms", type = int, default = 0, help = "how many of the existing rooms to spread the clients across (0 for all of them)")
+	parser.add_argument("--duration", type = float, default = 10, help = "how many seconds the clients chat for")
+	parser.add_argument("--rate", type = float, default = 0.5, help = "how many messages every client sends per second")
+	parser.add_argument("--history", type = int, default = 20, help = "how many old messages clients ask for when joining")
+	parser.add_argument("--refresh-share", type = float, default = 0.05, help = "the share of sends that are [refresh] instead of messages")
+	parser.add_argument("--command-share", type = float, default = 0.02, help = "the share of sends that are slash commands instead of messages")
+	parser.add_argument("--connect-concurrency", type = int, default = 50, help = "how many clients connect at once")
+	parser.add_argument("--drain", type = float, default = 2, help = "how many seconds to wait for messages to arrive after chatting")
+	parser.add_argument("--host", default = "localhost")
+	parser.add_argument("--port", type = int, default = 32761)
+	parser.add_argument("--workers", type = int, default = 1, help = "passed on to the server")
+	parser.add_argument("--no-server", action = "store_true", help = "connect to a server that is already running instead of starting one")
+	parser.add_argument("--output", help = "file to write the results to as JSON")
+	parser.add_argument("--compare", help = "results file from an earlier run to compare against")
+	options = parser.parse_args()
+	options.corpus = corpus
+	
+	raiseFileLimit()
+	
+	server = None
+	if not options.no_server:
+		server, workingDirectory = startServer(options)
+	try:
+		asyncio.run(waitForServer(options))
+		results = asyncio.run(runLoadTest(options, server.pid if server else None))
+	finally:
+		if server:
+			server.terminate()
+			server.wait()
+			shutil.rmtree(workingDirectory, ignore_errors = True)
+	
+	print(json.dumps(results, indent = 4))
+	if options.output:
+		with open(options.output, "w", encoding = "utf-8") as file:
+			json.dump(results, file, indent = 4)
+	if options.compare:
+		with open(options.compare, encoding = "utf-8") as file:
+			compare(results, json.load(file))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,151 @@
+import contextvars
+import tracemalloc
+import argparse
+import random
+import statistics
+import json
+import sys
+import server
+
+# Measures how much memory the server needs for every connection and every message that rooms keep around.
+# "before" rebuilds how that state used to be kept (four context variables per connection and every message as a str), "after" uses what server.py does now.
+# Rooms now also keep a search index over their history, which isn't part of "after" but gets reported as its own cost per message.
+
+corpus = [
+	"hello everyone",
+	"has anyone seen the new logix nodes? :o:",
+	"[b]important:[/b] meeting in 5 :cool:",
+	"lol :xd: :xd: :xd:",
+	"this message is a bit longer than the others because some people like to write whole paragraphs in chat, even in VR " * 2,
+	"schönen Abend zusammen!",
+	"こんばんは、みなさん",
+	"nice world 👍"
+]
+
+# returns how many bytes every item that build() returns took up on average.
+def measure(build, amount):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	items = build(amount)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	del items
+	return (after - before) / amount
+
+# how much space a context needs for its variables depends on their hashes, which depend on where in memory they ended up. So this measures with a few different sets of them and returns the median.
+def measureContexts(makeBuild, amount, sets = 9):
+	builds = [makeBuild() for number in range(sets)] # kept around so that every set ends up somewhere else
+	return statistics.median(measure(build, amount) for build in builds)
+
+# everything that comes from a client gets decoded from a websocket frame, so every message and user ID starts out as its own string.
+def fresh(text):
+	return text.encode("utf-8").decode("utf-8")
+
+def makeMessages(amount, users):
+	messages = []
+	for number in range(amount):
+		message = server.formatRichMessage(random.choice(corpus), None)
+		messages.append("msg:" + users[number % len(users)] + "|" + str(number % 3 != 0) + "|" + message)
+	return messages
+
+def messagesBefore(messages):
+	def build(amount):
+		history = server.MessageHistory(amount)
+		for message in messages:
+			history.append(fresh(message))
+		return history
+	return build
+
+# only the history itself, the search index that every room also keeps is measured on its own by searchIndex().
+def messagesAfter(messages):
+	def build(amount):
+		history = server.MessageHistory(amount)
+		for message in messages:
+			history.append(fresh(message).encode("utf-8"))
+		return history
+	return build
+
+def searchIndex(messages):
+	def build(amount):
+		index = server.SearchIndex()
+		for sequence, message in enumerate(messages):
+			index.add(sequence, fresh(message))
+		return index
+	return build
+
+def connectionsBefore(users):
+	socket = contextvars.ContextVar("socket")
+	userID = contextvars.ContextVar("userID", default = None)
+	verified = contextvars.ContextVar("verified")
+	currentRoom = contextvars.ContextVar("currentRoom", default = None)
+	websocket = object() # the websocket itself is the same either way
+	
+	def connect(number):
+		socket.set(websocket)
+		verified.set(False)
+		userID.set(fresh(users[number % len(users)]))
+		currentRoom.set(None)
+	
+	def build(amount):
+		contexts = []
+		for number in range(amount):
+			context = contextvars.copy_context() # every connection's task gets its own
+			context.run(connect, number)
+			contexts.append(context)
+		return contexts
+	return build
+
+def connectionsAfter(users):
+	websocket = object()
+	
+	def connect(number):
+		server.client.set(server.Connection(websocket, number))
+		server.client.get().userID = sys.intern(fresh(users[number % len(users)])) # like [iam] does
+		server.client.get().verified = True
+	
+	def build(amount):
+		contexts = []
+		for number in range(amount):
+			context = contextvars.copy_context()
+			context.run(connect, number)
+			contexts.append(context)
+		return contexts
+	return build
+
+def main():
+	parser = argparse.ArgumentParser(description = "Memory benchmark for the nChat server.")
+	parser.add_argument("--messages", type = int, default = 50000, help = "how many messages to keep in the history")
+	parser.add_argument("--connections", type = int, default = 20000, help = "how many connections to simulate")
+	parser.add_argument("--users", type = int, default = 500, help = "how many different user IDs the messages and connections have")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--output", help = "file to write the results to as JSON")
+	options = parser.parse_args()
+	random.seed(options.seed)
+	
+	users = ["U-BenchmarkUser" + str(number) for number in range(options.users)]
+	messages = makeMessages(options.messages, users)
+	results = {
+		"config": {"messages": options.messages, "connections": options.connections, "users": options.users},
+		"bytesPerMessage": {
+			"before": measure(messagesBefore(messages), options.messages),
+			"after": measure(messagesAfter(messages), options.messages),
+			"searchIndex": measure(searchIndex(messages), options.messages)
+		},
+		"bytesPerConnection": {
+			"before": measureContexts(lambda: connectionsBefore(users), options.connections),
+			"after": measureContexts(lambda: connectionsAfter(users), options.connections)
+		}
+	}
+	
+	for key in ("bytesPerMessage", "bytesPerConnection"):
+		before = results[key]["before"]
+		after = results[key]["after"]
+		print(key + ": " + format(before, ".1f") + " -> " + format(after, ".1f") + " (" + format((after / before - 1) * 100, "+.1f") + "%)")
+	searchIndexBytes = results["bytesPerMessage"]["searchIndex"]
+	print("bytesPerMessage with the search index: " + format(results["bytesPerMessage"]["after"] + searchIndexBytes, ".1f") + " (the index takes " + format(searchIndexBytes, ".1f") + ")")
+	if options.output:
+		with open(options.output, "w", encoding = "utf-8") as file:
+			json.dump(results, file, indent = 4)
+
+if __name__ == "__main__":
+	main()
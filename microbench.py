@@ -0,0 +1,179 @@
+import argparse
+import random
+import timeit
+import string
+import json
+import sys
+import subprocess
+import server
+import loadtest
+
+# Times the functions that every message goes through on their own, which is much quicker and less noisy than a whole load test.
+# Results can be saved with --output and a later run can be checked against them with --compare, which fails if anything got more than --threshold slower.
+# Every benchmark gets timed in lots of short rounds in a few separate processes and only the fastest round counts, since anything else running on the machine only ever makes rounds slower.
+# (Processes on their own can also be faster or slower than each other by quite a bit, for example because of where their memory ended up.)
+
+plainCorpus = [
+	"hello everyone",
+	"has anyone seen the new logix nodes?",
+	"i think the problem is that the slot gets destroyed before the driver runs",
+	"schönen Abend zusammen!",
+	"こんばんは、みなさん",
+	"this message is a bit longer than the others because some people like to write whole paragraphs in chat, even in VR"
+]
+emojiCorpus = [
+	":smile: :smile: :smile:",
+	"lol :xd: :xd: :xd: :xd:",
+	"gg :cool: :highfive: :o: :cheers:",
+	":gunleft: :sleep: :gunr:",
+	"well :hm: :hm: i guess ;shrug;"
+]
+tagCorpus = [
+	"[b]important:[/b] meeting in 5",
+	"[b][i]very[/i] [big]important[/big][/b]",
+	"[big][b][i][u]all[/u] of[/i] them[/b] at once[/big]",
+	"x[sup]2[/sup] + y[sub]i[/sub][br]second line",
+	"[b]unclosed [i]tags [big]everywhere"
+]
+
+# builds messages of 2000 characters (the longest that sendMessage lets through) out of all of the other corpora.
+def maxLengthCorpus(amount):
+	pieces = plainCorpus + emojiCorpus + tagCorpus
+	messages = []
+	for number in range(amount):
+		message = ""
+		while len(message) < 2000:
+			message += random.choice(pieces) + " "
+		messages.append(message[:2000])
+	return messages
+
+def randomWord():
+	return "".join(random.choice(string.ascii_lowercase) for character in range(random.randint(3, 10)))
+
+# a list of bad words where some of them actually show up in the plainCorpus.
+def badWordList(amount):
+	words = ["anyone", "slot", "paragraphs", "abend"][:amount]
+	while len(words) < amount:
+		words.append(randomWord())
+	return words
+
+# returns a function that runs function once for every item.
+def overCorpus(function, items):
+	def run():
+		for item in items:
+			function(item)
+	return run
+
+def formatBenchmark(corpus, badWords = []):
+	badWordFilter = server.compileBadWords(badWords)
+	return overCorpus(lambda message: server.formatRichMessage(message, badWordFilter), corpus), len(corpus)
+
+def censorBenchmark(wordCount):
+	badWordFilter = server.compileBadWords(badWordList(wordCount))
+	return overCorpus(lambda text: server.censorBadWords(text, badWordFilter), plainCorpus), len(plainCorpus)
+
+def makeRoom(messageLimit, alwaysOpen = False):
+	return server.applyEvent({"type": "createRoom", "name": "Benchmark", "icon": 0, "owner": "U-Benchmark", "alwaysOpen": alwaysOpen, "messageLimit": messageLimit, "readOnly": False, "badWords": badWordList(10), "historyKey": None, "connection": None})
+
+# adds messages to a room whose history is already full, so that every message pushes out the oldest one.
+def historyBenchmark(messageLimit):
+	room = makeRoom(messageLimit)
+	messages = ["msg:U-Benchmark|True|" + server.formatRichMessage(message, None) for message in plainCorpus + emojiCorpus + tagCorpus]
+	for number in range(messageLimit):
+		server.applyEvent({"type": "message", "room": room.id, "message": messages[number % len(messages)]})
+	events = [{"type": "message", "room": room.id, "message": message} for message in messages]
+	return overCorpus(server.applyEvent, events), len(events)
+
+# collects and serializes roomCount persistent rooms like writeDefaultRooms() does (without writing them to disk, which would only measure the disk).
+def saveBenchmark(roomCount):
+	server.rooms.clear()
+	for number in range(roomCount):
+		makeRoom(100, alwaysOpen = True)
+	def run():
+		json.dumps(server.defaultRoomsObject(), ensure_ascii = False, indent = 4)
+	return run, 1
+
+benchmarks = {
+	"formatRichMessage.plain": lambda: formatBenchmark(plainCorpus),
+	"formatRichMessage.emoji": lambda: formatBenchmark(emojiCorpus),
+	"formatRichMessage.tags": lambda: formatBenchmark(tagCorpus),
+	"formatRichMessage.maxLength": lambda: formatBenchmark(maxLengthCorpus(10)),
+	"formatRichMessage.maxLength.badWords100": lambda: formatBenchmark(maxLengthCorpus(10), badWordList(100)),
+	"censorBadWords.0": lambda: censorBenchmark(0),
+	"censorBadWords.10": lambda: censorBenchmark(10),
+	"censorBadWords.100": lambda: censorBenchmark(100),
+	"censorBadWords.1000": lambda: censorBenchmark(1000),
+	"history.append.100": lambda: historyBenchmark(100),
+	"history.append.1000": lambda: historyBenchmark(1000),
+	"saveDefaultRooms.100": lambda: saveBenchmark(100)
+}
+
+# returns how many seconds a single item took, from the fastest of the rounds. (Each round takes about 20ms.)
+def measure(function, items, rounds):
+	timer = timeit.Timer(function)
+	number, _ = timer.autorange() # runs it for at least 200ms
+	number = max(1, number // 10)
+	return min(timer.repeat(rounds, number)) / number / items
+
+def runBenchmarks(options):
+	results = {}
+	for name, setup in benchmarks.items():
+		if options.only and options.only not in name:
+			continue
+		random.seed(options.seed)
+		function, items = setup()
+		results[name] = measure(function, items, options.rounds)
+	return results
+
+# runs the benchmarks in a fresh process and returns their results.
+def runInProcess(options):
+	arguments = [sys.executable, __file__, "--rounds", str(options.rounds), "--seed", str(options.seed), "--single-process"] + (["--only", options.only] if options.only else [])
+	return json.loads(subprocess.run(arguments, capture_output = True, text = True, check = True).stdout)
+
+# prints how the results differ from an earlier run and returns the names of the benchmarks that got more than threshold slower.
+def compare(results, baseline, threshold):
+	regressions = []
+	for name, new in results["results"].items():
+		old = baseline["results"].get(name)
+		if old is None:
+			continue
+		change = new / old - 1
+		if change > threshold:
+			regressions.append(name)
+		print(name + ": " + format(old * 1e6, ".3f") + "µs -> " + format(new * 1e6, ".3f") + "µs (" + format(change * 100, "+.1f") + "%)" + (" SLOWER" if change > threshold else ""))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description = "Microbenchmarks for the message pipeline of the nChat server.")
+	parser.add_argument("--rounds", type = int, default = 50, help = "how many times to time every benchmark in every process (the fastest one counts)")
+	parser.add_argument("--processes", type = int, default = 3, help = "how many processes to run the benchmarks in")
+	parser.add_argument("--only", help = "only run the benchmarks whose name contains this")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--output", help = "file to write the results to as JSON (to use as a baseline later)")
+	parser.add_argument("--compare", help = "results file from an earlier run to compare against")
+	parser.add_argument("--threshold", type = float, default = 0.25, help = "how much slower (0.25 is 25%%) a benchmark can get compared to --compare before the run fails")
+	parser.add_argument("--single-process", action = "store_true", help = argparse.SUPPRESS) # used by runInProcess()
+	options = parser.parse_args()
+	if options.single_process:
+		print(json.dumps(runBenchmarks(options)))
+		return
+	
+	results = {"version": loadtest.serverVersion(), "config": {"rounds": options.rounds, "processes": options.processes, "seed": options.seed}, "results": {}}
+	for process in range(options.processes):
+		for name, seconds in runInProcess(options).items():
+			results["results"][name] = min(seconds, results["results"].get(name, seconds))
+	for name, seconds in results["results"].items():
+		print(name + ": " + format(seconds * 1e6, ".3f") + "µs")
+	
+	if options.output:
+		with open(options.output, "w", encoding = "utf-8") as file:
+			json.dump(results, file, indent = 4)
+	if options.compare:
+		with open(options.compare, encoding = "utf-8") as file:
+			regressions = compare(results, json.load(file), options.threshold)
+		if len(regressions) > 0:
+			print(str(len(regressions)) + " benchmark(s) got more than " + format(options.threshold * 100, "g") + "% slower: " + ", ".join(regressions))
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,223 @@
+import asyncio
+import websockets
+import argparse
+import shutil
+import time
+import json
+import loadtest
+from aiohttp import web
+
+# Replays traffic that was recorded with server.py --record against a local server, at the recorded speed or faster.
+# Every recorded connection gets its own client that sends the same frames at the same times (relative to the start of the recording). [verify] gets answered by a stub of the Neos API that knows the codes the local server handed out.
+# Rooms are referred to by their IDs, so the server should start out with the same rooms.json as the one that got recorded. The results get written as JSON so that different server versions can be compared on the same traffic.
+
+# reads the recorded files (in any order, lines from all of them get sorted by time) and returns (time, connection, kind, frame) tuples.
+def readRecordings(paths):
+	events = []
+	for path in paths:
+		with open(path, encoding = "utf-8") as file:
+			for line in file:
+				if line.startswith("#"):
+					continue
+				parts = line.rstrip("\n").split(" ", 3)
+				try:
+					events.append((float(parts[0]), parts[1], parts[2], json.loads(parts[3]) if len(parts) == 4 else None))
+				except (ValueError, IndexError): # the last line of a file can be cut off if the server crashed
+					continue
+	events.sort(key = lambda event: event[0])
+	return events
+
+# answers the server's requests for cloud variables like the Neos API would, with the verification codes in codes.
+class VerificationStub:
+	def __init__(self):
+		self.codes = {} # maps user IDs to the code the server last sent to one of their connections
+		self.runner = None
+	
+	async def readVariables(self, request):
+		jsonData = await request.json()
+		return web.json_response([{"variable": {"value": self.codes.get(jsonData[0]["ownerId"])}}])
+	
+	async def start(self, host, port):
+		app = web.Application()
+		app.router.add_post("/readvars", self.readVariables)
+		self.runner = web.AppRunner(app, access_log = None)
+		await self.runner.setup()
+		await web.TCPSite(self.runner, host, port).start()
+	
+	async def stop(self):
+		await self.runner.cleanup()
+
+# one recorded connection.
+class ReplayClient:
+	def __init__(self, options, report, stub):
+		self.options = options
+		self.report = report
+		self.stub = stub
+		self.frames = asyncio.Queue() # (frame, when it should get sent) tuples. A frame of None closes the connection.
+		self.userID = None
+		self.verificationCode = None
+		self.gotVerificationCode = asyncio.Event()
+		self.joinSent = None
+		self.closing = False
+	
+	async def run(self):
+		try:
+			self.websocket = await websockets.connect("ws://" + self.options.host + ":" + str(self.options.port), max_size = None)
+		except OSError:
+			self.report["connectFailures"] += 1
+			return
+		reader = asyncio.ensure_future(self.read())
+		while True:
+			frame, scheduledAt = await self.frames.get()
+			if frame is None:
+				break
+			if frame.startswith("[iam]"):
+				self.userID = frame[5:]
+			elif frame.startswith("[verify]") and self.userID is not None:
+				try:
+					await asyncio.wait_for(self.gotVerificationCode.wait(), 5)
+					self.stub.codes[self.userID] = self.verificationCode
+				except asyncio.TimeoutError:
+					pass
+			elif frame.startswith("[join]"):
+				self.joinSent = time.perf_counter()
+			self.report["sendLag"].append(time.perf_counter() - scheduledAt)
+			try:
+				await self.websocket.send(frame)
+			except websockets.exceptions.ConnectionClosed:
+				break
+			self.report["framesSent"] += 1
+		self.closing = True
+		await self.websocket.close()
+		reader.cancel()
+	
+	async def read(self):
+		try:
+			async for message in self.websocket:
+				receivedAt = time.perf_counter()
+				self.report["framesReceived"] += 1
+				if message.startswith("vrf:"):
+					self.verificationCode = message[4:]
+					self.gotVerificationCode.set()
+				elif message.startswith("jnd:") or (message.startswith("err:") and self.joinSent is not None):
+					if self.joinSent is not None:
+						self.report["joinLatencies"].append(receivedAt - self.joinSent)
+						self.joinSent = None
+				if message.startswith("err:"):
+					self.report["errors"] += 1
+		except websockets.exceptions.ConnectionClosed:
+			if not self.closing:
+				self.report["disconnects"] += 1
+
+# samples the server's memory while the replay runs.
+async def watchMemory(serverPid, report):
+	while True:
+		memory = loadtest.residentMemory(serverPid)
+		if memory is not None:
+			report["peakMemory"] = max(report["peakMemory"] or 0, memory)
+		await asyncio.sleep(1)
+
+async def runReplay(options, events, serverPid, stub):
+	report = {"framesSent": 0, "framesReceived": 0, "errors": 0, "disconnects": 0, "connectFailures": 0, "joinLatencies": [], "sendLag": [], "peakMemory": None}
+	memoryWatcher = asyncio.ensure_future(watchMemory(serverPid, report)) if serverPid else None
+	
+	clients = {} # maps the recorded connections that are currently open to their ReplayClient
+	tasks = []
+	firstTime = events[0][0]
+	start = time.perf_counter()
+	for recordedAt, connection, kind, frame in events:
+		scheduledAt = start + (recordedAt - firstTime) / options.speed
+		delay = scheduledAt - time.perf_counter()
+		if delay > 0:
+			await asyncio.sleep(delay)
+		# recordings can start after a connection was opened (if older files got rotated away)
+		if kind == "c" or (kind == "f" and connection not in clients):
+			clients[connection] = ReplayClient(options, report, stub)
+			tasks.append(asyncio.ensure_future(clients[connection].run()))
+		if kind == "f":
+			clients[connection].frames.put_nowait((frame, scheduledAt))
+		elif kind == "d" and connection in clients:
+			clients.pop(connection).frames.put_nowait((None, scheduledAt))
+	replayTime = time.perf_counter() - start
+	
+	# give the last frames a moment to get answered, then close whatever is still open
+	await asyncio.sleep(options.drain)
+	for replayClient in clients.values():
+		replayClient.frames.put_nowait((None, time.perf_counter()))
+	await asyncio.gather(*tasks)
+	if memoryWatcher:
+		memoryWatcher.cancel()
+	
+	return {
+		"version": loadtest.serverVersion(),
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+		"config": {
+			"recordings": options.recordings,
+			"speed": options.speed,
+			"workers": options.workers,
+			"connections": len(tasks),
+			"frames": sum(1 for event in events if event[2] == "f"),
+			"recordedDuration": events[-1][0] - firstTime
+		},
+		"results": {
+			"replayDuration": replayTime,
+			"framesSent": report["framesSent"],
+			"framesReceived": report["framesReceived"],
+			"framesReceivedPerSecond": report["framesReceived"] / replayTime if replayTime > 0 else None,
+			"errors": report["errors"],
+			"disconnects": report["disconnects"],
+			"connectFailures": report["connectFailures"],
+			"joinLatency": loadtest.summarize(report["joinLatencies"]),
+			"sendLag": loadtest.summarize(report["sendLag"]), # how late frames got sent. If this is high, the replay couldn't keep up and the other results aren't meaningful.
+			"peakMemory": report["peakMemory"]
+		}
+	}
+
+async def replay(options, events):
+	stub = VerificationStub()
+	await stub.start(options.host, options.stub_port)
+	server = None
+	if not options.no_server:
+		server, workingDirectory = loadtest.startServer(options, ["--verification-endpoint", "http://" + options.host + ":" + str(options.stub_port) + "/readvars"], options.rooms)
+	try:
+		await loadtest.waitForServer(options)
+		return await runReplay(options, events, server.pid if server else None, stub)
+	finally:
+		if server:
+			server.terminate()
+			server.wait()
+			shutil.rmtree(workingDirectory, ignore_errors = True)
+		await stub.stop()
+
+def main():
+	parser = argparse.ArgumentParser(description = "Replays traffic recorded with server.py --record against a local nChat server.")
+	parser.add_argument("recordings", nargs = "+", help = "the record files to replay (with rotated and per-worker files, pass all of them)")
+	parser.add_argument("--speed", type = float, default = 1, help = "how many times faster than recorded to replay the traffic")
+	parser.add_argument("--drain", type = float, default = 2, help = "how many seconds to wait for answers after the last frame")
+	parser.add_argument("--rooms", help = "rooms.json to start the server with (defaults to the one next to server.py)")
+	parser.add_argument("--host", default = "localhost")
+	parser.add_argument("--port", type = int, default = 32761)
+	parser.add_argument("--stub-port", type = int, default = 32762, help = "port for the stub of the Neos API that answers [verify]")
+	parser.add_argument("--workers", type = int, default = 1, help = "passed on to the server")
+	parser.add_argument("--no-server", action = "store_true", help = "replay against a server that is already running (it needs to be started with --verification-endpoint pointing at the stub)")
+	parser.add_argument("--output", help = "file to write the results to as JSON")
+	parser.add_argument("--compare", help = "results file from an earlier replay to compare against")
+	options = parser.parse_args()
+	
+	events = readRecordings(options.recordings)
+	if len(events) == 0:
+		print("There is nothing to replay.")
+		return
+	loadtest.raiseFileLimit()
+	results = asyncio.run(replay(options, events))
+	
+	print(json.dumps(results, indent = 4))
+	if options.output:
+		with open(options.output, "w", encoding = "utf-8") as file:
+			json.dump(results, file, indent = 4)
+	if options.compare:
+		with open(options.compare, encoding = "utf-8") as file:
+			loadtest.compare(results, json.load(file), ("joinLatency",), ("framesReceivedPerSecond", "peakMemory"))
+
+if __name__ == "__main__":
+	main()
@@ -6,17 +6,192 @@ import aiohttp
 import os
 import re
 import json
+import signal
+import bisect
+import array
+import sqlite3
+import argparse
+import multiprocessing
+import tempfile
+import traceback
+import time
+import subprocess
+import sys
+import io
+import hashlib
+import threading
+import collections
+from socket import socket as Socket
+from aiohttp import web
+from websockets.frames import Frame, Opcode
+try:
+	from PIL import Image # only needed for building the sprite atlas
+except ImportError:
+	Image = None
+
+# METRICS
+# These are kept cheap enough to always be on. They can be read through the metricsPort (in the Prometheus text format) or with /metrics.
+
+# keeps track of how often something took how long.
+class Timing:
+	__slots__ = ("count", "total", "max")
+	
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+	
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+counters = {
+	"messages": 0, # chat messages and videos sent
+	"verifications": 0, # requests to the verificationEndpoint that worked
+	"verificationFailures": 0, # requests to the verificationEndpoint that failed (including ones that got retried)
+	"rateLimitedChat": 0, # frames that got rejected because a connection or user went over their rate limit
+	"rateLimitedRefresh": 0,
+	"rateLimitedRoom": 0,
+	"rateLimitedVerify": 0,
+	"slowCallbacks": 0 # callbacks that blocked the event loop for longer than slowCallbackThreshold
+}
+timings = {
+	"registryLockWait": Timing(),
+	"registryLockHold": Timing(),
+	"roomLockWait": Timing(), # for the locks of all rooms together
+	"roomLockHold": Timing(),
+	"formatRichMessage": Timing(),
+	"broadcast": Timing(),
+	"verification": Timing(),
+	"saveDefaultRooms": Timing()
+}
+messageRate = 0.0 # messages per second over the last 10 seconds
+startTime = time.time()
+
+# an asyncio.Lock that records how long it gets waited for and held in timings.
+class TimedLock:
+	__slots__ = ("lock", "waitTiming", "holdTiming", "acquiredAt")
+	
+	def __init__(self, name):
+		self.lock = asyncio.Lock()
+		self.waitTiming = timings[name + "Wait"]
+		self.holdTiming = timings[name + "Hold"]
+		self.acquiredAt = 0.0
+	
+	async def __aenter__(self):
+		waitStart = time.perf_counter()
+		await self.lock.acquire()
+		self.acquiredAt = time.perf_counter()
+		self.waitTiming.add(self.acquiredAt - waitStart)
+	
+	async def __aexit__(self, *exception):
+		self.holdTiming.add(time.perf_counter() - self.acquiredAt)
+		self.lock.release()
 
 # VARIABLE DEFINITIONS
 
-rooms = [] # list of all rooms
+rooms = {} # maps the IDs of all rooms to the rooms themselves (in the order they were created in)
 lastRoomID = 0 # id of the last created room. Gets incremented by 1 for every new room
-roomLock = asyncio.Lock() # lock that ensures no concurrent access to the rooms[] array. (Not sure where/if entirely necessary with asyncio but better safe than sorry.)
+roomLimit = 100 # how many rooms can exist at once
+registryLock = TimedLock("registryLock") # lock that guards the rooms{} dict and which users are in which room. (If both this and a room's lock are needed, this one has to be aquired first.)
+lobbySnapshot = None # tuple of the rom: messages for all rooms that gets sent to clients in the lobby. Set to None whenever it needs to be rebuilt.
+lobbySubscribers = set() # websockets of clients that sent [subscribe] and get told about changes to the room list as they happen
+lobbyChanges = {} # maps the IDs of rooms that changed since the last lobby update to "room", "userCount" or "removed"
+lobbyUpdateInterval = 0.25 # how many seconds changes to the room list get collected for before they are sent to the lobbySubscribers
+lobbyUpdateTask = None # the task that sends the next lobby update (if one is scheduled)
+directoryPageSize = 20 # how many rooms a page of the room directory has if the client doesn't say (see [rooms] in takeClient)
+directoryPageLimit = 100 # the most rooms a page of the room directory can have
+
+client = contextvars.ContextVar("client") # the Connection of the user in the current context
+activity = contextvars.ContextVar("activity", default = None) # the frame (without its content) that the client in the current context is being handled for, for the slow callback log
+
+outboxes = {} # maps every connected websocket to the queue of messages that are waiting to be sent to it (until it starts disconnecting)
+outboundQueueSize = 256 # how many messages can be waiting to be sent to a single client before outboundOverflowPolicy kicks in
+outboundOverflowPolicy = "dropOldest" # what happens to clients that can't keep up. "dropOldest" drops their oldest unsent messages, "disconnect" disconnects them with an error.
+historyBatchSize = 50 # how many old messages get packed into one hst: message at most
+historyPageLimit = 500 # how many old messages a client can ask for at once (with [join] or [history])
+searchResultLimit = 10 # how many messages /search shows at most
+compression = True # use permessage-deflate with clients that support it
+compressBroadcasts = True # compress broadcasts too (see SharedMessage). This costs one compression per recipient, but since every client keeps its own compression context, chat lines get less than half as big. False sends the same uncompressed frame to everyone.
+
+connectionLimit = 5000 # how many clients can be connected at once (to every worker). Anyone above that gets an err: and is disconnected right away.
+pingInterval = 15 # how many seconds to wait between pinging every client to check that they are still there (None to not ping them)
+pingTimeout = 15 # how many seconds a client has to answer a ping before they get disconnected
+closeTimeout = 5 # how many seconds a client has to acknowledge being disconnected before the connection just gets dropped
+identifyTimeout = 30 # how many seconds a client has to send [iam] before they get disconnected (None to never disconnect them for that)
+idleTimeout = 7200 # how many seconds a client can go without sending anything before they get disconnected (None to never disconnect them for that)
+reapInterval = 5 # how many seconds to wait between checking for clients that went over identifyTimeout or idleTimeout
+reapRound = 0 # how often reapConnections() has checked so far. Connections remember the round they were last active in instead of the time, so that they all share the same int.
+maxFrameSize = 16384 # the biggest frame (in bytes) a client can send. Clients that send bigger ones get disconnected.
+inboundQueueSize = 8 # how many received frames from a single client can be waiting to be handled before the server stops reading from them
+readLimit = 65536 # how many bytes from a single client can be waiting in the receive buffer before the server stops reading from them
+writeLimit = 65536 # how many bytes to a single client can be waiting in the send buffer before writeOutbox() waits for them to be sent
+
+workerID = 0 # which worker process this is (when running with --workers)
+backplane = None # the backplane that events get published to (see the EVENTS section)
+connections = {} # maps the IDs of all connections to this worker process to their Connection
+lastConnectionID = 0 # id of the last connection to this worker process. Gets incremented by 1 for every new connection (events use connectionKey() instead, which is unique across workers)
+
+historyDatabase = None # path to an SQLite file that the messages of persistent rooms get saved to, so they survive restarts. (None to not save them)
+historyFlushInterval = 1 # how many seconds new messages get collected for before they are written to the historyDatabase
+historyLog = None # the HistoryLog for historyDatabase, if there is one
+
+roomSaveDelay = 2 # how many seconds to wait for further changes to persistent rooms before writing rooms.json
+roomSaveTask = None # the task that will write rooms.json, if one is scheduled
+roomSaveLock = asyncio.Lock() # makes sure only one thread writes rooms.json at a time
+
+verificationEndpoint = "https://api.neos.com/api/readvars" # where the cloud variables of users get read from to verify them
+verificationTimeout = 10 # how many seconds a single request to the verificationEndpoint may take
+verificationRetries = 2 # how often a failed request to the verificationEndpoint gets retried
+verificationConcurrency = 16 # how many requests to the verificationEndpoint can be made at once
+verificationClient = None # the VerificationClient that talks to the verificationEndpoint
+
+metricsPort = None # port to serve metrics on over HTTP (None to not do that)
+metricsRunner = None # the aiohttp runner of the metrics server (if there is one)
+slowCallbackThreshold = 0.1 # how many seconds a single callback may block the event loop for before it gets logged (None to not check)
+slowCallbacks = collections.deque(maxlen = 5) # descriptions of the latest slow callbacks, for /metrics (all of them get printed)
+profileInterval = 0.01 # how many seconds pass between two samples while profiling
+profileMaxDuration = 60 # how many seconds /profile can profile for at most
+profileDirectory = "profiles" # where /profile writes its files to
+profiling = False # whether /profile is currently running
+
+assetPort = None # port to serve the emoji and room icons on over HTTP (None to not do that)
+assetRunner = None # the aiohttp runner of the asset server (if there is one)
+assetDirectories = {"emoji": "Emoji", "icons": "Room Icons"} # maps URL paths to the directories that get served there (relative to server.py)
+assetCheckInterval = 10 # how many seconds to wait between checking the assetDirectories for changes
+spriteNameOverrides = {"Hm": "confused", "XD": "grin", "Sleeping": "sleep"} # emoji files whose sprite name isn't just their file name in snake_case
+iconFileNames = {"???": "qqq"} # room icons whose file name (lowercase) isn't just their name in iconNames
+atlasWidth = 256 # how wide the sprite atlas is, in pixels (it gets as high as it needs to be)
+atlasPadding = 2 # empty pixels between the sprites in the atlas
+assets = {} # maps the URL paths of all assets to (body, ETag, content type)
+
+recordPath = None # file to record every frame that clients send to, so that the traffic can be replayed later with replay.py (None to not record anything)
+recordFileSize = 64 * 1024 ** 2 # how big (in bytes) the record file can get before it gets rotated
+recordFileCount = 4 # how many rotated record files to keep around besides the current one
+recordFlushInterval = 1 # how many seconds recorded frames get collected for before they are written to the record file
+recorder = None # the TrafficRecorder for recordPath, if there is one
 
-socket = contextvars.ContextVar("socket") # the user socket of the current context
-userID = contextvars.ContextVar("userID", default = None) # the userID of the user in the current context (if authenticated)
-verified = contextvars.ContextVar("verified") # the userID of the user in the current context (if authenticated)
-currentRoom = contextvars.ContextVar("currentRoom", default = None) # the room that the user in the current context is in
+handingOff = False # whether this process is handing its clients and rooms off to a new one (see handOff())
+handoffDrainTimeout = 5 # how many seconds to wait for clients to disconnect before handing off the rooms anyway
+handoffReadyTimeout = 30 # how many seconds the new process gets to take over the rooms and start accepting connections before the handoff counts as failed
+handoffGracePeriod = 60 # how many seconds rooms that got handed off get to wait for their users to come back before they are removed (unless they are always open)
+
+# how fast clients can do things, as (tokens per second, burst size). Every frame of that kind costs one token.
+connectionRateLimits = { # for every connection on its own
+	"chat": (3, 10), # [message]
+	"refresh": (1, 5), # [refresh], [subscribe], [rooms] and [history]
+	"room": (0.1, 2), # [room]
+	"verify": (0.2, 3) # [verify]
+}
+userRateLimits = { # for all verified connections with the same userID together (on one worker)
+	"chat": (5, 15),
+	"refresh": (2, 10),
+	"room": (0.1, 3),
+	"verify": (0.5, 5)
+}
+userBuckets = {} # maps userIDs to their token buckets for each kind in userRateLimits
 
 iconAmount = 19
 iconNames = [
@@ -122,7 +297,7 @@ richMessageCodes = [
 	("[/big]", "</size>")
 ]
 
-# SLASH COMMANDS (all of these are called with the room lock already engaged and with currentRoom existing)
+# SLASH COMMANDS (all of these are called with the lock of currentRoom already engaged and with currentRoom existing)
 # All of them return a boolean for whether or not the command was successful.
 
 globalAdmins = ["U-Psychpsyo"]
@@ -130,63 +305,47 @@ alwaysAdmins = ["U-Psychpsyo"]
 
 async def clearBadWords(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	currentRoom.get()["badWords"] = []
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, badWords = [])
 	return True
 
 async def addBadWord(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	currentRoom.get()["badWords"].append(params)
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, addBadWord = params)
 	return True
 
 async def removeBadWord(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	try:
-		currentRoom.get()["badWords"].remove(params)
-		# save default (always open) rooms to file if necessary
-		if currentRoom.get()["alwaysOpen"]:
-			saveDefaultRooms()
-		return True
-	except ValueError:
-		await socket.get().send("err:The word you were trying to remove was not on the list of bad words.")
+	if params not in client.get().room.badWords:
+		reply("err:The word you were trying to remove was not on the list of bad words.")
 		return False
+	await updateRoom(client.get().room, removeBadWord = params)
+	return True
 
 async def setRoomName(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	# set room name and inform all users in the room
-	currentRoom.get()["name"] = params
-	for user in currentRoom.get()["users"]:
-		await user.send("nme:" + "<noparse=" + str(len(params)) + ">" + params)
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, name = params)
 	return True
 
 async def setRoomIcon(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
 	newIcon = -1
@@ -204,169 +363,213 @@ async def setRoomIcon(params):
 	
 	# validate the parsed index
 	if newIcon < 0 or newIcon >= iconAmount:
-		await socket.get().send("err:You specified an invalid room icon.")
+		reply("err:You specified an invalid room icon.")
 		return False
 	
-	currentRoom.get()["icon"] = newIcon
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, icon = newIcon)
 	return True
 
 # makes it so that the room does not disappear when everyone leaves it.
 async def makePersistent(params):
 	# check if the user is a global admin
-	if userID.get() not in globalAdmins or not verified.get():
-		await socket.get().send("err:You must be a verified admin to use this command.")
+	if client.get().userID not in globalAdmins or not client.get().verified:
+		reply("err:You must be a verified admin to use this command.")
 		return False
 	
-	currentRoom.get()["alwaysOpen"] = True
-	saveDefaultRooms()
+	await updateRoom(client.get().room, alwaysOpen = True)
 	return True
 
 # makes it so that the room disappears when everyone leaves it.
 async def makeNonpersistent(params):
 	# check if the user is a global admin or owner of the room and verified
-	if (userID.get() not in globalAdmins and currentRoom.get()["owner"] != userID.get()) or not verified.get():
-		await socket.get().send("err:You must be a verified admin or owner of this room to use this command.")
+	if (client.get().userID not in globalAdmins and client.get().room.owner != client.get().userID) or not client.get().verified:
+		reply("err:You must be a verified admin or owner of this room to use this command.")
 		return False
 	
-	currentRoom.get()["alwaysOpen"] = False
+	await updateRoom(client.get().room, alwaysOpen = False)
 	return True
 
 # remove all messages from the current room.
 async def clearMessageHistory(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	currentRoom.get()["messages"] = []
-	# inform all users in the room
-	for user in currentRoom.get()["users"]:
-		await user.send("clr")
+	await backplane.publish({"type": "clearHistory", "room": client.get().room.id})
 	return True
 
 # give someone admin permissions.
 async def grantAdminPerms(params):
 	# check if the user is a global admin
-	if userID.get() not in globalAdmins or not verified.get():
-		await socket.get().send("err:You must be a verified admin to use this command.")
+	if client.get().userID not in globalAdmins or not client.get().verified:
+		reply("err:You must be a verified admin to use this command.")
 		return False
 	
 	if not params.startswith("U-") or " " in params or params == "": # this is only a very crude, incorrect way to verify a user ID but it should at least avoid some typos.
-		await socket.get().send("err:You must supply makeadmin with a valid user ID.")
+		reply("err:You must supply makeadmin with a valid user ID.")
 		return False
 	
-	try:
-		globalAdmins.remove(params)
-		return True
-	except ValueError:
-		await socket.get().send("err:" + params + " is not an admin.")
+	if params in globalAdmins:
+		reply("err:" + params + " is already an admin.")
 		return False
+	await backplane.publish({"type": "updateAdmins", "add": params})
+	return True
 
 # revoke someone's admin permissions.
 async def removeAdminPerms(params):
 	# check if the user is a global admin
-	if userID.get() not in globalAdmins or not verified.get():
-		await socket.get().send("err:You must be a verified admin to use this command.")
+	if client.get().userID not in globalAdmins or not client.get().verified:
+		reply("err:You must be a verified admin to use this command.")
 		return False
 	
 	if not params.startswith("U-") or " " in params: # this is only a very crude, incorrect way to verify a user ID but it should at least avoid some typos.
-		await socket.get().send("err:You must supply makeadmin with a valid user ID.")
+		reply("err:You must supply makeadmin with a valid user ID.")
 		return False
 	
 	# is the user in alwaysAdmins? (undemoteable)
 	if params in alwaysAdmins:
-		await socket.get().send("err:You cannot take admin perms from " + params + ".")
+		reply("err:You cannot take admin perms from " + params + ".")
 		return False
 	
-	globalAdmins.remove(params)
+	if params not in globalAdmins:
+		reply("err:" + params + " is not an admin.")
+		return False
+	await backplane.publish({"type": "updateAdmins", "remove": params})
 	return True
 
 # sends a video in the current room.
 async def sendVideo(params):
+	if not client.get().userID:
+		reply("err:Client did not provide user ID. You won't be able to send messages.")
+		return False
 	if len(params) == 0:
-		await socket.get().send("err:You must supply a video link.")
+		reply("err:You must supply a video link.")
 		return False
 	
-	message = "vid:" + userID.get() + "|" + str(verified.get()) + "|" + params
+	message = "vid:" + client.get().userID + "|" + str(client.get().verified) + "|" + params
 	
-	currentRoom.get()["messages"].append(message)
-	currentRoom.get()["messages"] = currentRoom.get()["messages"][-currentRoom.get()["messageLimit"]:]
-	for user in currentRoom.get()["users"]:
-		await user.send(message)
+	await backplane.publish({"type": "message", "room": client.get().room.id, "message": message})
 	return True
 
 # sets the limit for how many of the messages in the current room are kept around.
 async def setMessageLimit(params):
 	# check if the user is a global admin or owner of the room and verified
-	if (userID.get() not in globalAdmins and currentRoom.get()["owner"] != userID.get()) or not verified.get():
-		await socket.get().send("err:You must be a verified admin or owner of this room to use this command.")
+	if (client.get().userID not in globalAdmins and client.get().room.owner != client.get().userID) or not client.get().verified:
+		reply("err:You must be a verified admin or owner of this room to use this command.")
 		return False
 	
 	try:
 		params = int(params)
 	except:
-		await socket.get().send("err:You must supply the command with a number.")
+		reply("err:You must supply the command with a number.")
 		return False
 	
 	if params < 0:
-		await socket.get().send("err:Number of messages retained cannot be negative.")
+		reply("err:Number of messages retained cannot be negative.")
 		return False
 	
 	# check if the user is a global admin when setting to a high value.
-	if params > 100 and (userID.get() not in globalAdmins or not verified.get()):
-		await socket.get().send("err:You must be a verified admin to set the message limit to more than 100.")
+	if params > 100 and (client.get().userID not in globalAdmins or not client.get().verified):
+		reply("err:You must be a verified admin to set the message limit to more than 100.")
 		return False
 	
-	currentRoom.get()["messageLimit"] = params
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, messageLimit = params)
 	return True
 
 # transfer ownership of the current room to someone else.
 async def transferOwnership(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
 	if not params.startswith("U-") or " " in params or params == "": # this is only a very crude, incorrect way to verify a user ID but it should at least avoid some typos.
-		await socket.get().send("err:You must supply tranferownership with a valid user ID.")
+		reply("err:You must supply tranferownership with a valid user ID.")
 		return False
 	
-	currentRoom.get()["owner"] = params
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, owner = params)
 	return True
 
 # sets the current room to read only, so no new messages can be sent in it (except by the owner)
 async def makeReadOnly(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	currentRoom.get()["readOnly"] = True
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, readOnly = True)
 	return True
 
 # disables readonly in the current room so people can send messages again
 async def unmakeReadOnly(params):
 	# check if the user is the owner of the room
-	if currentRoom.get()["owner"] != userID.get() or not verified.get():
-		await socket.get().send("err:You must be the verified owner of this room to use this command.")
+	if client.get().room.owner != client.get().userID or not client.get().verified:
+		reply("err:You must be the verified owner of this room to use this command.")
 		return False
 	
-	currentRoom.get()["readOnly"] = False
-	# save default (always open) rooms to file if necessary
-	if currentRoom.get()["alwaysOpen"]:
-		saveDefaultRooms()
+	await updateRoom(client.get().room, readOnly = False)
+	return True
+
+# shows the metrics of this server. (see the METRICS section)
+async def showMetrics(params):
+	# check if the user is a global admin
+	if client.get().userID not in globalAdmins or not client.get().verified:
+		reply("err:You must be a verified admin to use this command.")
+		return False
+	
+	lines = [
+		"Clients: " + str(len(connections)) + ", rooms: " + str(len(rooms)) + ", messages/s: " + format(messageRate, ".1f"),
+		"Users per room: " + ", ".join(str(room.id) + ": " + str(room.userCount) for room in rooms.values())
+	]
+	for name, timing in timings.items():
+		if timing.count > 0:
+			lines.append(name + ": " + format(timing.total / timing.count * 1000, ".3f") + "ms avg, " + format(timing.max * 1000, ".3f") + "ms max (" + str(timing.count) + "x)")
+	lines.append("Verification failures: " + str(counters["verificationFailures"]))
+	lines.append("Slow callbacks: " + str(counters["slowCallbacks"]))
+	lines.extend(slowCallbacks)
+	replyInfo("\n".join(lines))
+	return True
+
+# samples where the server spends its time for a number of seconds and writes the result to a file in the profileDirectory. (see the PROFILING section)
+async def startProfiling(params):
+	global profiling
+	# check if the user is a global admin
+	if client.get().userID not in globalAdmins or not client.get().verified:
+		reply("err:You must be a verified admin to use this command.")
+		return False
+	
+	try:
+		duration = float(params) if params else 10
+	except ValueError:
+		reply("err:You must supply the number of seconds to profile for.")
+		return False
+	if not 0 < duration <= profileMaxDuration:
+		reply("err:You can only profile for up to " + str(profileMaxDuration) + " seconds.")
+		return False
+	if profiling:
+		reply("err:The server is already being profiled.")
+		return False
+	
+	profiling = True
+	asyncio.ensure_future(takeProfile(duration))
+	replyInfo("Profiling for " + format(duration, "g") + " seconds.")
+	return True
+
+# shows the newest messages in the current room that contain all of the given words. Only the user who searched sees them.
+async def searchHistory(params):
+	words = searchWords(params)
+	if len(words) == 0:
+		reply("err:You must supply something to search for.")
+		return False
+	
+	room = client.get().room
+	results = []
+	for sequence in room.searchIndex.find(words, searchResultLimit):
+		sender, _, text = room.messages.at(sequence).decode("utf-8")[4:].partition("|")
+		text = stripTags(text.partition("|")[2]).strip()
+		results.append(sender + ": " + (text if len(text) <= 200 else text[:200] + "..."))
+	replyInfo("\n".join(results) if len(results) > 0 else "No messages found.")
 	return True
 
 slashCommands = {
@@ -384,99 +587,700 @@ slashCommands = {
 	"setmessagelimit": setMessageLimit,
 	"transferownership": transferOwnership,
 	"makereadonly": makeReadOnly,
-	"unmakereadonly": unmakeReadOnly
+	"unmakereadonly": unmakeReadOnly,
+	"metrics": showMetrics,
+	"profile": startProfiling,
+	"search": searchHistory
+}
+
+# FUNCTIONS THAT PERTAIN TO SENDING DATA TO CLIENTS
+# None of these wait for the data to actually be sent, they only put it into the client's outbox. (which gets sent by writeOutbox())
+
+# queues up a message (or a list of messages that should be sent together) for a client.
+def send(websocket, message):
+	outbox = outboxes.get(websocket)
+	if outbox is None: # client is already disconnecting
+		return
+	
+	# deal with clients that aren't receiving messages as fast as they are getting sent
+	if outbox.qsize() >= outboundQueueSize:
+		if outboundOverflowPolicy == "disconnect":
+			disconnectClient(websocket, "err:You were disconnected for not receiving messages fast enough.", 1008)
+			return
+		outbox.get_nowait()
+	outbox.put_nowait(message)
+
+def broadcast(users, message):
+	broadcastStart = time.perf_counter()
+	sharedMessage = SharedMessage(message)
+	for user in users:
+		send(user, sharedMessage)
+	timings["broadcast"].add(time.perf_counter() - broadcastStart)
+
+# sends a message to the user in the current context.
+def reply(message):
+	send(client.get().websocket, message)
+
+# sends multiple messages to a client. These only take up one spot in the outbox.
+def sendBatch(websocket, messages):
+	messages = list(messages)
+	if len(messages) > 0:
+		send(websocket, messages)
+
+def replyBatch(messages):
+	sendBatch(client.get().websocket, messages)
+
+# sends a line of text to the user in the current context that only they see. (as a message from themselves, like the echo of slash commands)
+def replyInfo(text):
+	reply("msg:" + client.get().userID + "|" + str(client.get().verified) + "|<color=#bbf><noparse=" + str(len(text)) + ">" + text)
+
+# drops everything that is still waiting to be sent to a client, sends them an error and disconnects them with the given close code. (from closeReasons)
+def disconnectClient(websocket, error, code):
+	outbox = outboxes.pop(websocket)
+	while not outbox.empty():
+		outbox.get_nowait()
+	outbox.put_nowait(error)
+	outbox.put_nowait(code) # tells writeOutbox() to close the connection
+
+# closes the connection to a client with the given close code (from closeReasons) once everything that is already in their outbox got sent.
+# Nothing else can get queued up for them after this, so the overflow policy can't push the close out of the outbox.
+def closeClient(websocket, code):
+	outbox = outboxes.pop(websocket, None)
+	if outbox is not None:
+		outbox.put_nowait(code)
+
+closeReasons = {
+	1008: "Client too slow",
+	1012: "Server restarting",
+	1013: "Server full",
+	4000: "Did not identify",
+	4001: "Idle for too long"
 }
 
+# a message (str or already encoded as UTF-8) that gets sent to lots of clients. It only gets encoded once and only gets turned into an uncompressed frame once for all the clients that get it uncompressed.
+class SharedMessage:
+	__slots__ = ("data", "frame")
+	
+	def __init__(self, message):
+		self.data = message if isinstance(message, bytes) else message.encode("utf-8")
+		self.frame = None
+	
+	# Servers don't mask their frames, so the same bytes work for every client.
+	def uncompressedFrame(self):
+		if self.frame is None:
+			self.frame = Frame(opcode = Opcode.TEXT, data = self.data).serialize(mask = False)
+		return self.frame
+
+# writes a SharedMessage to a websocket. Clients that negotiated permessage-deflate get it compressed with their own compression context (unless compressBroadcasts is off), everyone else gets the shared frame.
+async def writeShared(websocket, message):
+	await websocket.ensure_open()
+	if compressBroadcasts and websocket.extensions:
+		await websocket.write_frame(True, Opcode.TEXT, message.data)
+	else:
+		websocket.transport.write(message.uncompressedFrame())
+		await websocket.drain()
+
+# sends everything that lands in the outbox of a websocket, one message at a time. (runs as its own task for every client)
+async def writeOutbox(websocket, outbox):
+	try:
+		while True:
+			message = await outbox.get()
+			if isinstance(message, int): # a close code
+				await websocket.close(message, closeReasons[message])
+				return
+			if isinstance(message, SharedMessage): # from broadcast()
+				await writeShared(websocket, message)
+			elif isinstance(message, str):
+				await websocket.send(message)
+			else:
+				for batchedMessage in message:
+					if isinstance(batchedMessage, SharedMessage):
+						await writeShared(websocket, batchedMessage)
+					else:
+						await websocket.send(batchedMessage)
+	except websockets.exceptions.ConnectionClosed:
+		pass
+	finally:
+		# nothing else can get sent to this client, so nothing else needs to get queued up for them either
+		outboxes.pop(websocket, None)
+
+# disconnects clients that didn't send [iam] within identifyTimeout seconds or didn't send anything for idleTimeout seconds.
+async def reapConnections():
+	global reapRound
+	while True:
+		await asyncio.sleep(reapInterval)
+		reapRound += 1
+		for connection in list(connections.values()):
+			if connection.websocket not in outboxes: # already disconnecting
+				continue
+			inactive = (reapRound - connection.lastActive) * reapInterval # (to within reapInterval)
+			if identifyTimeout is not None and connection.userID is None and inactive > identifyTimeout:
+				disconnectClient(connection.websocket, "err:You were disconnected for not identifying yourself.", 4000)
+			elif idleTimeout is not None and inactive > idleTimeout:
+				disconnectClient(connection.websocket, "err:You were disconnected for being idle for too long.", 4001)
+
 # FUNCTIONS THAT PERTAIN TO CORE ROOM MANAGEMENT / MESSAGE SENDING
 
-# returns room on sucess or an error string on error.
-async def createNewRoom(name, icon, userID, bySystem = False, messageLimit = 100, readOnly = False, badWords = []):
-	global lastRoomID
-	global iconAmount
-	global rooms
-	async with roomLock:
-		# validate room
-		if len(rooms) >= 100:
-			return "Room cap reached, cannot create more rooms."
-		if len(name) == 0:
-			name = "Unnamed Room #" + str(lastRoomID)
-		# validate userID if the room isn't created by the system
-		if not bySystem and not verified.get():
-			return "Unverified users cannot create rooms.\nYou need to connect from your dash to verify your identity to create a room."
+# everything about one connected client.
+class Connection:
+	__slots__ = ("websocket", "id", "userID", "verified", "room", "lastActive")
+	
+	def __init__(self, websocket, id):
+		self.websocket = websocket
+		self.id = id # a number that is only unique on this worker, events use connectionKey()
+		self.userID = None # the userID the client claims to have (only to be trusted if verified is True, interned since users often have several connections)
+		self.verified = False
+		self.room = None # the room the client is in
+		self.lastActive = reapRound # the reapRound the client last sent something in (pings don't count). Until the client says who it is, this stays the one it connected in.
+
+# how events refer to a connection.
+def connectionKey(connection):
+	return str(workerID) + "-" + str(connection.id)
+
+# returns the connection that an event refers to with a connectionKey(), or None if it isn't connected to this worker.
+def eventConnection(key):
+	worker, _, connectionID = key.partition("-")
+	return connections.get(int(connectionID)) if int(worker) == workerID else None
+
+# a rate limit that allows burst actions at once and refills at rate actions per second. limit is the (rate, burst) tuple from connectionRateLimits or userRateLimits, which all buckets of a kind share.
+class TokenBucket:
+	__slots__ = ("limit", "tokens", "updated")
+	
+	def __init__(self, limit, now):
+		self.limit = limit
+		self.tokens = limit[1]
+		self.updated = now # buckets that get created together share this until they get used
+	
+	def refill(self):
+		now = time.monotonic()
+		rate, burst = self.limit
+		self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+		self.updated = now
+	
+	# takes a token and returns True, or returns False if there is none left.
+	def take(self):
+		self.refill()
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+	
+	def isFull(self):
+		self.refill()
+		return self.tokens >= self.limit[1]
+
+# returns whether the connection in the current context (and its user) can do one more action of the given kind and uses up a token if so.
+# The limits for the user only apply once they are verified. Anyone can claim any userID with [iam], so otherwise they could use up someone else's tokens.
+def takeToken(connectionBuckets, kind):
+	if not connectionBuckets[kind].take():
+		counters["rateLimited" + kind.capitalize()] += 1
+		return False
+	if client.get().verified:
+		buckets = userBuckets.get(client.get().userID)
+		if buckets is None:
+			now = time.monotonic()
+			buckets = {limitKind: TokenBucket(limit, now) for limitKind, limit in userRateLimits.items()}
+			userBuckets[client.get().userID] = buckets
+		if not buckets[kind].take():
+			counters["rateLimited" + kind.capitalize()] += 1
+			return False
+	return True
+
+# forgets the token buckets of users that haven't done anything in a while. (a full bucket is the same as a new one)
+async def pruneUserBuckets():
+	while True:
+		await asyncio.sleep(60)
+		for user in [user for user, buckets in userBuckets.items() if all(bucket.isFull() for bucket in buckets.values())]:
+			del userBuckets[user]
+
+# the last few messages that were sent in a room, oldest first.
+# Once it is full, new messages overwrite the oldest one in place so that nothing needs to get copied around.
+# Every message also gets a sequence number (counting up from 0) that clients use to ask for older messages.
+class MessageHistory:
+	__slots__ = ("items", "start", "count", "limit", "total")
+	
+	def __init__(self, limit):
+		self.items = [] # only grows up to the limit, after that it gets written to in a circle
+		self.start = 0 # index of the oldest message in items (always 0 until the history is full)
+		self.count = 0
+		self.limit = limit
+		self.total = 0 # how many messages were ever added, which is also the sequence number of the next message
+	
+	def __len__(self):
+		return self.count
+	
+	def __iter__(self):
+		for offset in range(self.count):
+			yield self.items[(self.start + offset) % self.limit]
+	
+	# adds a message to the history and returns the message that had to be removed for it (or None)
+	def append(self, message):
+		self.total += 1
+		if self.limit == 0:
+			return message
+		if self.count < self.limit:
+			if self.count == len(self.items):
+				self.items.append(message)
+			else:
+				self.items[self.count] = message
+			self.count += 1
+			return None
 		
-		# truncate room name to 50 characters.
-		if len(name) > 50:
-			name = name[:50]
+		oldMessage = self.items[self.start]
+		self.items[self.start] = message
+		self.start = (self.start + 1) % self.limit
+		return oldMessage
+	
+	# changes the limit, removing the oldest messages if there are too many. Returns a list of the removed messages.
+	def resize(self, limit):
+		messages = list(self)
+		removed = messages[:max(0, len(messages) - limit)]
+		self.items[:] = messages[len(removed):]
+		self.start = 0
+		self.count = len(self.items)
+		self.limit = limit
+		return removed
+	
+	# returns the message with the given sequence number (or None if it isn't in the history anymore)
+	def at(self, sequence):
+		oldest = self.total - self.count
+		if sequence < oldest or sequence >= self.total:
+			return None
+		return self.items[(self.start + sequence - oldest) % self.limit]
+	
+	# returns the sequence number of the first of up to amount messages that came before the given sequence number, and those messages.
+	def before(self, sequence, amount):
+		oldest = self.total - self.count
+		end = min(max(sequence, oldest), self.total)
+		start = max(oldest, end - amount)
+		return start, [self.items[(self.start + index - oldest) % self.limit] for index in range(start, end)]
+	
+	def clear(self):
+		# keep the list around (so that it does not need to grow again) but let go of the messages in it
+		for index in range(self.count):
+			self.items[index] = None
+		self.start = 0
+		self.count = 0
+
+class Room:
+	__slots__ = ("id", "name", "users", "userCount", "lock", "owner", "messages", "icon", "alwaysOpen", "badWords", "badWordFilter", "readOnly", "historyKey", "searchIndex")
+	
+	def __init__(self, id, name, owner, icon, messageLimit, alwaysOpen, badWords, readOnly, historyKey):
+		self.id = id
+		self.name = name
+		self.users = set() # the websockets of the users in this room (only the ones connected to this worker)
+		self.userCount = 0 # the users on all workers
+		self.lock = TimedLock("roomLock") # guards the messages and settings of this room
+		self.owner = owner
+		self.messages = MessageHistory(messageLimit) # the messages are kept as UTF-8 since that takes less memory than a str
+		self.searchIndex = SearchIndex()
+		self.icon = icon
+		self.alwaysOpen = alwaysOpen
+		self.badWords = list(badWords)
+		self.badWordFilter = compileBadWords(badWords)
+		self.readOnly = readOnly
+		self.historyKey = historyKey
+
+# maps words to the messages in a room's history that contain them so that /search doesn't need to look at every message.
+# The sequence numbers for every word are in ascending order since messages only ever get added at the end and removed at the start.
+class SearchIndex:
+	__slots__ = ("postings",)
+	
+	def __init__(self):
+		self.postings = {} # maps every word to an array of the sequence numbers of the messages that contain it (8 bytes each instead of a pointer to an int object)
+	
+	def add(self, sequence, message):
+		for word in searchWords(messageText(message)):
+			postings = self.postings.get(word)
+			if postings is None:
+				self.postings[word] = array.array("q", (sequence,))
+			else:
+				postings.append(sequence)
+	
+	# needs to be called for every message that falls out of the history, oldest first.
+	def remove(self, sequence, message):
+		for word in searchWords(messageText(message)):
+			postings = self.postings.get(word)
+			if postings and postings[0] == sequence:
+				if len(postings) == 1:
+					del self.postings[word]
+				else:
+					del postings[0]
+	
+	def clear(self):
+		self.postings.clear()
+	
+	# returns the sequence numbers of the up to limit newest messages that contain all of the words, newest first.
+	def find(self, words, limit):
+		postingLists = sorted((self.postings.get(word, ()) for word in words), key = len)
+		# go through the rarest word's messages and look the others up by bisecting their lists
+		results = []
+		for sequence in reversed(postingLists[0]):
+			if all(postingsContain(postings, sequence) for postings in postingLists[1:]):
+				results.append(sequence)
+				if len(results) == limit:
+					break
+		return results
+
+def postingsContain(postings, sequence):
+	index = bisect.bisect_left(postings, sequence)
+	return index < len(postings) and postings[index] == sequence
+
+tagPattern = re.compile("<[^>]*>")
+wordPattern = re.compile("\\w+")
+
+# returns the text of a msg: or vid: message, without the user ID and verified flag in front.
+def messageText(message):
+	return message.split("|", 2)[-1]
+
+def stripTags(text):
+	return tagPattern.sub("", text)
+
+# returns the set of all (lowercase) words in a message, ignoring rich text tags.
+def searchWords(text):
+	return set(wordPattern.findall(stripTags(text).lower()))
+
+# keeps the keys of all rooms in a sorted list so that the room directory can go through the rooms in that order without sorting them every time.
+# Every key ends with the negative ID of its room, which makes the keys unique and puts newer rooms first if everything else is equal.
+class RoomOrder:
+	__slots__ = ("key", "keys", "roomKeys")
+	
+	def __init__(self, key):
+		self.key = key # function that returns the key of a room
+		self.keys = [] # the keys of all rooms, in ascending order
+		self.roomKeys = {} # maps the IDs of all rooms to their key
+	
+	def update(self, room):
+		key = self.key(room)
+		if self.roomKeys.get(room.id) == key:
+			return
+		self.remove(room.id)
+		bisect.insort(self.keys, key)
+		self.roomKeys[room.id] = key
+	
+	def remove(self, roomID):
+		key = self.roomKeys.pop(roomID, None)
+		if key is not None:
+			del self.keys[bisect.bisect_left(self.keys, key)]
+	
+	# yields the keys that come after cursor (or all of them if it is None), in order.
+	def after(self, cursor):
+		for position in range(bisect.bisect_right(self.keys, cursor) if cursor is not None else 0, len(self.keys)):
+			yield self.keys[position]
+
+# answers [rooms] queries for one page of the room list at a time, filtered and sorted. Gets kept up to date by lobbyChanged().
+class RoomDirectory:
+	def __init__(self):
+		self.orders = {
+			"users": RoomOrder(lambda room: (-room.userCount, -room.id)), # most users first
+			"new": RoomOrder(lambda room: (-room.id,)) # newest first
+		}
+		self.byOwner = {} # maps owners to the IDs of their rooms
+		self.byIcon = {} # maps icons to the IDs of the rooms that have them
+		self.filedUnder = {} # maps the IDs of all rooms to the (owner, icon) they are in byOwner and byIcon under
+	
+	def update(self, room):
+		for order in self.orders.values():
+			order.update(room)
+		if self.filedUnder.get(room.id) != (room.owner, room.icon):
+			self.unfile(room.id)
+			self.byOwner.setdefault(room.owner, set()).add(room.id)
+			self.byIcon.setdefault(room.icon, set()).add(room.id)
+			self.filedUnder[room.id] = (room.owner, room.icon)
+	
+	def remove(self, roomID):
+		for order in self.orders.values():
+			order.remove(roomID)
+		self.unfile(roomID)
+	
+	def unfile(self, roomID):
+		filed = self.filedUnder.pop(roomID, None)
+		if filed is None:
+			return
+		owner, icon = filed
+		self.byOwner[owner].discard(roomID)
+		if len(self.byOwner[owner]) == 0:
+			del self.byOwner[owner]
+		self.byIcon[icon].discard(roomID)
+		if len(self.byIcon[icon]) == 0:
+			del self.byIcon[icon]
+	
+	# returns up to limit rooms that come after cursor (the key of the last room on the page before, or None) in the given order and match all of the filters that aren't None.
+	# Also returns the cursor for the next page (None if there are no more rooms).
+	# name is matched case-insensitively anywhere in a room's name and has to be lowercase already.
+	def query(self, sort, cursor, limit, name = None, icon = None, owner = None):
+		order = self.orders[sort]
+		candidates = None
+		if owner is not None:
+			candidates = self.byOwner.get(owner, set())
+		if icon is not None:
+			iconRooms = self.byIcon.get(icon, set())
+			candidates = iconRooms if candidates is None else candidates & iconRooms
+		if candidates is None:
+			keys = order.after(cursor)
+		else:
+			# there usually aren't many of these, so sorting them is quicker than going through every room
+			keys = sorted(order.roomKeys[roomID] for roomID in candidates)
+			if cursor is not None:
+				keys = keys[bisect.bisect_right(keys, cursor):]
 		
-		# turn invalid icons into icon 0 (???)
-		if icon < 0 or icon >= iconAmount:
-			icon = 0
+		page = []
+		lastKey = None
+		for key in keys:
+			room = rooms[-key[-1]]
+			if name is not None and name not in room.name.lower():
+				continue
+			if len(page) == limit:
+				return page, lastKey
+			page.append(room)
+			lastKey = key
+		return page, None
+
+roomDirectory = RoomDirectory()
+
+# writes the history of persistent rooms to an SQLite database in the background.
+# Changes are collected in memory and written in batches every historyFlushInterval seconds, in a worker thread.
+class HistoryLog:
+	def __init__(self, path):
+		self.connection = sqlite3.connect(path, check_same_thread = False) # only ever used by one thread at a time
+		self.connection.execute("PRAGMA journal_mode = WAL")
+		self.connection.execute("PRAGMA synchronous = NORMAL")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS messages (room TEXT NOT NULL, sequence INTEGER NOT NULL, message TEXT NOT NULL, PRIMARY KEY (room, sequence)) WITHOUT ROWID")
+		self.connection.commit()
+		self.pending = [] # changes that still need to be written
+		self.writing = asyncio.Lock() # so that flushes that overlap (like the one at shutdown and flushContinuously()) don't use the connection at the same time and write in order
+	
+	def add(self, room, sequence, message):
+		self.pending.append((room.historyKey, sequence, message, room.messages.limit))
+	
+	def clear(self, room):
+		self.pending.append((room.historyKey, None, None, None))
+	
+	# returns the last limit messages of a room as (sequence number, message) tuples, oldest first.
+	# Thanks to the primary key, this only reads the end of the room's log, no matter how long it is.
+	def load(self, room, limit):
+		rows = self.connection.execute("SELECT sequence, message FROM messages WHERE room = ? ORDER BY sequence DESC LIMIT ?", (room.historyKey, limit)).fetchall()
+		rows.reverse()
+		return rows
+	
+	# gets run in a worker thread.
+	def write(self, changes):
+		newest = {} # the newest sequence number and message limit of every room that got messages
+		with self.connection:
+			for historyKey, sequence, message, limit in changes:
+				if sequence is None:
+					self.connection.execute("DELETE FROM messages WHERE room = ?", (historyKey,))
+					newest.pop(historyKey, None)
+				else:
+					self.connection.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?)", (historyKey, sequence, message))
+					newest[historyKey] = (sequence, limit)
+			# drop the messages that fell out of the rooms' histories
+			for historyKey, (sequence, limit) in newest.items():
+				self.connection.execute("DELETE FROM messages WHERE room = ? AND sequence <= ?", (historyKey, sequence - limit))
+	
+	async def flush(self):
+		async with self.writing:
+			changes = self.pending
+			self.pending = []
+			if len(changes) > 0:
+				try:
+					await asyncio.get_event_loop().run_in_executor(None, self.write, changes)
+				except sqlite3.Error as error:
+					print("Could not write message history: " + str(error))
+	
+	async def flushContinuously(self):
+		while True:
+			await asyncio.sleep(historyFlushInterval)
+			await self.flush()
+
+# reads the verification codes that users put into their cloud variables from the verificationEndpoint.
+# All requests share one connection pool and if the same user ID gets asked for multiple times at once, only one request is made.
+class VerificationClient:
+	def __init__(self, endpoint):
+		self.endpoint = endpoint
+		self.session = None # gets created on first use since it needs the event loop to be running
+		self.requestSlots = asyncio.Semaphore(verificationConcurrency)
+		self.inFlight = {} # maps user IDs to the requests for them that are currently running
+	
+	# returns the verification code the user put into their cloud variable (or None if there isn't one)
+	# Raises aiohttp.ClientError or asyncio.TimeoutError if the verificationEndpoint could not be reached.
+	async def readVerificationCode(self, userID):
+		request = self.inFlight.get(userID)
+		if request is None:
+			request = asyncio.ensure_future(self.fetchVerificationCode(userID))
+			self.inFlight[userID] = request
+			request.add_done_callback(lambda request: self.inFlight.pop(userID, None))
+		# shielded so that one of the waiting connections closing doesn't cancel the request for the others
+		return await asyncio.shield(request)
+	
+	async def fetchVerificationCode(self, userID):
+		if self.session is None:
+			self.session = aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = verificationTimeout))
+		async with self.requestSlots:
+			for attempt in range(verificationRetries + 1):
+				requestStart = time.perf_counter()
+				try:
+					# ask Neos API for their cloud var
+					async with self.session.post(self.endpoint, json = [{"ownerId": userID, "path": "U-Psychpsyo.verificationCode"}]) as response:
+						response.raise_for_status()
+						jsonData = await response.json()
+					timings["verification"].add(time.perf_counter() - requestStart)
+					counters["verifications"] += 1
+					break
+				except (aiohttp.ClientError, asyncio.TimeoutError):
+					counters["verificationFailures"] += 1
+					if attempt == verificationRetries:
+						raise
+					await asyncio.sleep(0.5 * 2 ** attempt)
 		
-		# create the room
-		lastRoomID += 1
-		rooms.append({
-			"id": lastRoomID,
-			"name": name,
-			"users": [] if bySystem else [socket.get()],
-			"owner": userID,
-			"messages": [],
-			"icon": icon,
-			"alwaysOpen": True if bySystem else False,
-			"badWords": badWords,
-			"messageLimit": messageLimit,
-			"readOnly": readOnly
-		})
+		try:
+			return jsonData[0].get("variable", {}).get("value", None)
+		except (LookupError, AttributeError): # the API sent back something unexpected
+			return None
+	
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+
+# returns an error string on error.
+async def createNewRoom(name, icon, userID, bySystem = False, messageLimit = 100, readOnly = False, badWords = [], historyKey = None):
+	# validate userID if the room isn't created by the system
+	if not bySystem and not client.get().verified:
+		return "Unverified users cannot create rooms.\nYou need to connect from your dash to verify your identity to create a room."
+	
+	# truncate room name to 50 characters.
+	if len(name) > 50:
+		name = name[:50]
+	
+	# turn invalid icons into icon 0 (???)
+	if icon < 0 or icon >= iconAmount:
+		icon = 0
+	
+	event = {
+		"type": "createRoom",
+		"name": name,
+		"icon": icon,
+		"owner": userID,
+		"alwaysOpen": bySystem,
+		"messageLimit": messageLimit,
+		"readOnly": readOnly,
+		"badWords": list(badWords),
+		"historyKey": historyKey or os.urandom(8).hex(), # identifies the room in the historyDatabase across restarts
+		"connection": None if bySystem else connectionKey(client.get()) # the creator of the room, who joins it right away
+	}
+	async with registryLock:
+		# every worker creates the rooms from rooms.json by itself, so those don't go through the backplane.
+		room = applyEvent(event) if bySystem else await backplane.publish(event)
+	if isinstance(room, str):
+		return room
+	
+	if not bySystem:
+		client.get().room = room
+
+# compiles a room's list of bad words into a single case-insensitive regex (or None if there are no bad words)
+# The words get merged into a trie first so that matching does not get slower with every word that gets added.
+def compileBadWords(badWords):
+	trie = {}
+	for word in badWords:
+		if word == "":
+			continue
+		node = trie
+		for character in word:
+			node = node.setdefault(character, {})
+		node[""] = {} # marks the end of a word
+	
+	if len(trie) == 0:
+		return None
+	return re.compile(badWordTrieToPattern(trie), flags=re.IGNORECASE)
+
+def badWordTrieToPattern(node):
+	alternatives = []
+	for character, child in node.items():
+		if character == "":
+			continue
+		# follow chains of single characters in a loop so that long words do not hit the recursion limit
+		chain = character
+		while len(child) == 1 and "" not in child:
+			character, child = next(iter(child.items()))
+			chain += character
+		alternatives.append(re.escape(chain) + badWordTrieToPattern(child))
+	# the end of a word goes last so that longer bad words are preferred over shorter ones that they start with
+	if "" in node:
+		alternatives.append("")
+	
+	if len(alternatives) == 1:
+		return alternatives[0]
+	return "(?:" + "|".join(alternatives) + ")"
+
+# replaces bad words in a chain of plain text with stars.
+def censorBadWords(text, badWordFilter):
+	if badWordFilter is None:
+		return text
+	return badWordFilter.sub(lambda match: "*" * len(match.group()), text)
+
+# compiles a list of (code, replacement) pairs into a function that formats a message in a single left-to-right pass.
+# The result is the same as splitting the message on each code in list order, so codes that come earlier in the list win over overlapping codes that come later in it, even if those start earlier in the message.
+def compileRichMessageCodes(codes):
+	replacements = {}
+	priorities = {}
+	for code, replacement in codes:
+		if code not in replacements:
+			priorities[code] = len(priorities)
+			replacements[code] = replacement
+	# the lookahead makes this find overlapping occurrences of codes as well, these get resolved by priority below.
+	codeFinder = re.compile("(?=(" + "|".join(re.escape(code) for code in replacements) + "))")
+	
+	def formatMessage(message, badWordFilter):
+		codeMatches = [(match.start(), match.group(1)) for match in codeFinder.finditer(message)]
 		
-		# add user to the room
-		if not bySystem:
-			currentRoom.set(rooms[-1])
-			await socket.get().send("jnd:" + "<noparse=" + str(len(rooms[-1]["name"])) + ">" + rooms[-1]["name"])
-
-def formatRichMessage(message, badWords):
-	newMessage = [message]
-	for code in richMessageCodes:
-		message = newMessage
-		newMessage = []
-		for part in message:
-			splitPart = part.split(code[0])
-			originalInsertPos = len(splitPart) - 1
-			for x in range(len(splitPart) - 1):
-				splitPart.insert(originalInsertPos - x, code[0])
-			newMessage += splitPart
-	
-	# at this point newMessage is the fully split message, so we can clear message and start parsing newMessage into it.
-	message = ""
-	
-	currentChain = "" # the current chain of non-emoji text that needs to be escaped
-	for part in newMessage:
-		currentCode = next((code for code in richMessageCodes if code[0] == part), None)
-		if currentCode:
+		# check if any of the found codes overlap, which is rare enough to not need to be fast.
+		lastEnd = 0
+		for start, code in codeMatches:
+			if start < lastEnd:
+				codeMatches = resolveOverlaps(codeMatches)
+				break
+			lastEnd = start + len(code)
+		
+		formattedMessage = []
+		lastEnd = 0
+		for start, code in codeMatches:
 			# we have reached an RTF tag, replace bad words with stars and write to message
-			for word in badWords:
-				currentChain = re.sub(re.escape(word), "*" * len(word), currentChain, flags=re.IGNORECASE)
-			
+			currentChain = censorBadWords(message[lastEnd:start], badWordFilter)
 			# insert the noparse and append to message
-			message += "<noparse=" + str(len(currentChain)) + ">" + currentChain + currentCode[1]
-			currentChain = ""
-		else:
-			currentChain += part
-	
-	# we may have some currentChain left over
-	if currentChain != "":
-		# also censor bad words here!
-		for word in badWords:
-			currentChain = re.sub(re.escape(word), "*" * len(word), currentChain, flags=re.IGNORECASE)
+			formattedMessage.append("<noparse=" + str(len(currentChain)) + ">" + currentChain + replacements[code])
+			lastEnd = start + len(code)
 		
-		message += "<noparse=" + str(len(currentChain)) + ">" + currentChain
+		# we may have some currentChain left over
+		if lastEnd < len(message):
+			currentChain = censorBadWords(message[lastEnd:], badWordFilter)
+			formattedMessage.append("<noparse=" + str(len(currentChain)) + ">" + currentChain)
+		
+		# return the fully substituted and replaced string
+		return "".join(formattedMessage)
+	
+	# picks out the codes that would survive splitting the message on every code in list order.
+	def resolveOverlaps(codeMatches):
+		acceptedStarts = []
+		acceptedCodes = []
+		for start, code in sorted(codeMatches, key = lambda codeMatch: (priorities[codeMatch[1]], codeMatch[0])):
+			index = bisect.bisect(acceptedStarts, start)
+			if index > 0 and acceptedStarts[index - 1] + len(acceptedCodes[index - 1]) > start:
+				continue
+			if index < len(acceptedStarts) and acceptedStarts[index] < start + len(code):
+				continue
+			acceptedStarts.insert(index, start)
+			acceptedCodes.insert(index, code)
+		return list(zip(acceptedStarts, acceptedCodes))
 	
-	# return the fully substituted and replaced string
-	return message
+	return formatMessage
+
+formatRichMessage = compileRichMessageCodes(richMessageCodes)
 
-# gets called with roomLock already aquired.
+# gets called with the lock of currentRoom already aquired.
 async def sendMessage(message):
 	# do not send messages if you have no userID
-	if not userID.get():
-		await socket.get().send("err:Client did not provide user ID. You won't be able to send messages.")
+	if not client.get().userID:
+		reply("err:Client did not provide user ID. You won't be able to send messages.")
 		return
 	
 	# trim whitespace off message
@@ -494,65 +1298,756 @@ async def sendMessage(message):
 		isVideo = True
 	else:
 		# parse emoji and RTF tags into the message (this step also escapes all other RTF sequences.)
-		badWords = []
-		badWords = currentRoom.get()["badWords"]
-		
-		message = formatRichMessage(message, badWords)
+		formatStart = time.perf_counter()
+		message = formatRichMessage(message, client.get().room.badWordFilter)
+		timings["formatRichMessage"].add(time.perf_counter() - formatStart)
 	
 	# prepare final message string
-	message = ("vid:" if isVideo else "msg:") + userID.get() + "|" + str(verified.get()) + "|" + message
+	message = ("vid:" if isVideo else "msg:") + client.get().userID + "|" + str(client.get().verified) + "|" + message
+	
+	await backplane.publish({"type": "message", "room": client.get().room.id, "message": message})
+
+# adds a message to the history of a room (and the historyDatabase if the room is persistent)
+# encoded is the message as UTF-8, which is how the history keeps it.
+def addToHistory(room, message, encoded):
+	appendMessage(room, message, encoded)
+	if historyLog and room.alwaysOpen:
+		historyLog.add(room, room.messages.total - 1, message)
+
+# adds a message to the history of a room and its searchIndex without logging it.
+def appendMessage(room, message, encoded):
+	removed = room.messages.append(encoded)
+	room.searchIndex.add(room.messages.total - 1, message)
+	if removed is not None:
+		room.searchIndex.remove(room.messages.total - 1 - room.messages.limit, removed.decode("utf-8"))
+
+# turns how many old messages a client asked for into a number of at most historyPageLimit. Returns None if it isn't a number or negative.
+def parseHistoryAmount(amount):
+	try:
+		amount = int(amount)
+	except ValueError:
+		return None
+	return min(amount, historyPageLimit) if amount >= 0 else None
+
+# sends up to amount messages from before the given sequence number to a client, packed into as few hst: messages as possible.
+# Each hst: message starts with the sequence number to ask for older messages with (-1 if there are none) and then has every message as <length>|<message>.
+def sendHistory(websocket, history, before, amount):
+	start, messages = history.before(before, amount)
+	messages = [message.decode("utf-8") for message in messages]
+	oldest = history.total - len(history)
+	frames = []
+	for offset in range(0, max(len(messages), 1), historyBatchSize):
+		cursor = start + offset if start + offset > oldest else -1
+		frames.append("hst:" + str(cursor) + "|" + "".join(str(len(message)) + "|" + message for message in messages[offset:offset + historyBatchSize]))
+	sendBatch(websocket, frames)
+
+# removes the user in the current context from their room. (which also deletes the room if it is now empty)
+async def leaveCurrentRoom():
+	async with registryLock:
+		room = client.get().room
+		if room:
+			async with room.lock:
+				await backplane.publish({"type": "leaveRoom", "room": room.id, "connection": connectionKey(client.get())})
+			client.get().room = None
+
+# changes settings of a room on all workers. (see applyUpdateRoom() for which settings can be changed)
+async def updateRoom(room, **changes):
+	await backplane.publish({"type": "updateRoom", "room": room.id, "changes": changes})
+
+# needs to be called whenever a room gets added or removed or something that shows up in the room list changes.
+# change is "room" if the room is new or its name, icon or owner changed, "userCount" if only its user count changed or "removed" if it got removed.
+def lobbyChanged(room, change):
+	global lobbySnapshot
+	global lobbyUpdateTask
+	if change == "removed":
+		roomDirectory.remove(room.id)
+	else:
+		roomDirectory.update(room)
+	lobbySnapshot = None
+	if len(lobbySubscribers) == 0:
+		return
+	
+	# a room that got removed stays removed and "room" already includes the user count
+	previousChange = lobbyChanges.get(room.id)
+	if previousChange != "removed" and not (previousChange == "room" and change == "userCount"):
+		lobbyChanges[room.id] = change
+	if lobbyUpdateTask is None:
+		lobbyUpdateTask = asyncio.ensure_future(sendLobbyUpdateLater())
+
+# sends everything that changed in the last lobbyUpdateInterval seconds to the lobbySubscribers as a single batch.
+async def sendLobbyUpdateLater():
+	global lobbyUpdateTask
+	await asyncio.sleep(lobbyUpdateInterval)
+	lobbyUpdateTask = None
 	
-	currentRoom.get()["messages"].append(message)
-	currentRoom.get()["messages"] = currentRoom.get()["messages"][-currentRoom.get()["messageLimit"]:]
+	updates = []
+	for roomID, change in lobbyChanges.items():
+		room = rooms.get(roomID)
+		if change == "removed" or room is None:
+			updates.append("rmv:" + str(roomID))
+		elif change == "room":
+			updates.append(roomListEntry(room))
+		else:
+			updates.append("usr:" + str(roomID) + "|" + str(room.userCount))
+	lobbyChanges.clear()
 	
-	for user in currentRoom.get()["users"]:
-		await user.send(message)
+	# the updates only get encoded once and the batch is shared by everyone
+	sharedUpdates = tuple(SharedMessage(update) for update in updates)
+	for subscriber in lobbySubscribers:
+		send(subscriber, sharedUpdates)
+
+def roomListEntry(room):
+	return "rom:" + str(room.id) + "|" + room.owner + "|" + str(room.userCount) + "|" + str(room.icon) + "|" + "<noparse=" + str(len(room.name)) + ">" + room.name
 
+# sends the full room list to the user in the current context.
+# this does not need any locks since the snapshot only ever gets replaced, never modified.
 async def refreshRoomList():
-	global rooms
-	async with roomLock:
-		for room in rooms:
-			await socket.get().send("rom:" + str(room["id"]) + "|" + room["owner"] + "|" + str(len(room["users"])) + "|" + str(room["icon"]) + "|" + "<noparse=" + str(len(room["name"])) + ">" + room["name"])
+	global lobbySnapshot
+	if lobbySnapshot is None:
+		lobbySnapshot = tuple(roomListEntry(room) for room in rooms.values())
+	replyBatch(lobbySnapshot)
+
+# sends one page of the room directory to the user in the current context. (see [rooms] in takeClient)
+# All of the parameters are the strings that the client sent, which can be empty to use the default.
+def sendRoomDirectory(sort, pageSize, cursor, icon, owner, name):
+	try:
+		sort = sort or "users"
+		if sort not in roomDirectory.orders:
+			raise ValueError()
+		pageSize = min(int(pageSize), directoryPageLimit) if pageSize else directoryPageSize
+		if pageSize < 1:
+			raise ValueError()
+		cursor = tuple(int(part) for part in cursor.split(",")) if cursor else None
+		icon = int(icon) if icon else None
+	except ValueError:
+		reply("err:Could not understand which rooms to list.")
+		return
+	
+	page, nextCursor = roomDirectory.query(sort, cursor, pageSize, name.lower() or None, icon, owner or None)
+	replyBatch(["dir:" + (",".join(str(part) for part in nextCursor) if nextCursor else "")] + [roomListEntry(room) for room in page])
 
-# gets called with roomLock already aquired.
+# schedules rooms.json to be written after roomSaveDelay seconds. Any other changes until then get written along with this one.
+# When running with --workers, only the first worker writes it.
 def saveDefaultRooms():
+	global roomSaveTask
+	if roomSaveTask is None and workerID == 0:
+		roomSaveTask = asyncio.ensure_future(writeDefaultRoomsLater())
+
+async def writeDefaultRoomsLater():
+	global roomSaveTask
+	await asyncio.sleep(roomSaveDelay)
+	roomSaveTask = None
+	await writeDefaultRooms()
+
+# writes rooms.json right away if a write is scheduled and waits for any write that is already happening. (for shutting down)
+async def flushDefaultRooms():
+	global roomSaveTask
+	if roomSaveTask is not None:
+		roomSaveTask.cancel()
+		roomSaveTask = None
+		await writeDefaultRooms()
+	async with roomSaveLock:
+		pass
+
+async def writeDefaultRooms():
+	# the rooms are collected here, without awaiting anything, so that no room can change halfway through.
+	roomsObject = defaultRoomsObject()
+	async with roomSaveLock:
+		saveStart = time.perf_counter()
+		try:
+			await asyncio.get_event_loop().run_in_executor(None, writeJsonFile, "rooms.json", roomsObject)
+		except OSError as error:
+			print("Could not save rooms: " + str(error))
+		timings["saveDefaultRooms"].add(time.perf_counter() - saveStart)
+
+# returns what gets written to rooms.json.
+def defaultRoomsObject():
 	roomsObject = {"rooms": []}
-	for room in rooms:
-		if room["alwaysOpen"]:
+	for room in rooms.values():
+		if room.alwaysOpen:
 			roomsObject["rooms"].append({
-				"name": room["name"],
-				"icon": room["icon"],
-				"owner": room["owner"],
-				"messageLimit": room["messageLimit"],
-				"readOnly": room["readOnly"],
-				"badWords": room["badWords"]
+				"name": room.name,
+				"icon": room.icon,
+				"owner": room.owner,
+				"messageLimit": room.messages.limit,
+				"readOnly": room.readOnly,
+				"badWords": list(room.badWords),
+				"historyKey": room.historyKey
 			})
+	return roomsObject
+
+# gets run in a worker thread.
+# The data gets written to a temporary file first, which then replaces the old file. That way, a crash halfway through can't leave a broken file behind.
+def writeJsonFile(path, data):
+	temporaryPath = path + ".tmp"
+	with open(temporaryPath, "w", encoding = "utf-8") as file:
+		json.dump(data, file, ensure_ascii = False, indent = 4)
+		file.flush()
+		os.fsync(file.fileno())
+	os.replace(temporaryPath, path)
+
+# returns all metrics in the Prometheus text format.
+def renderMetrics():
+	lines = [
+		"# TYPE nchat_connected_clients gauge",
+		"nchat_connected_clients " + str(len(connections)),
+		"# TYPE nchat_rooms gauge",
+		"nchat_rooms " + str(len(rooms)),
+		"# TYPE nchat_room_users gauge"
+	]
+	for room in rooms.values():
+		lines.append("nchat_room_users{room=\"" + str(room.id) + "\"} " + str(room.userCount))
+	lines.append("# TYPE nchat_messages_per_second gauge")
+	lines.append("nchat_messages_per_second " + str(messageRate))
+	for name, value in counters.items():
+		lines.append("# TYPE nchat_" + name + "_total counter")
+		lines.append("nchat_" + name + "_total " + str(value))
+	for name, timing in timings.items():
+		lines.append("# TYPE nchat_" + name + "_seconds summary")
+		lines.append("nchat_" + name + "_seconds_sum " + str(timing.total))
+		lines.append("nchat_" + name + "_seconds_count " + str(timing.count))
+		lines.append("# TYPE nchat_" + name + "_seconds_max gauge")
+		lines.append("nchat_" + name + "_seconds_max " + str(timing.max))
+	lines.append("# TYPE nchat_uptime_seconds gauge")
+	lines.append("nchat_uptime_seconds " + str(time.time() - startTime))
+	return "\n".join(lines) + "\n"
+
+async def serveMetrics(request):
+	return web.Response(text = renderMetrics(), content_type = "text/plain", headers = {"Cache-Control": "no-store"})
+
+async def startMetricsServer(host, port):
+	global metricsRunner
+	app = web.Application()
+	app.router.add_get("/metrics", serveMetrics)
+	metricsRunner = web.AppRunner(app, access_log = None)
+	await metricsRunner.setup()
+	await web.TCPSite(metricsRunner, host, port).start()
+
+# keeps messageRate up to date.
+async def measureMessageRate():
+	global messageRate
+	counts = [counters["messages"]] * 10
+	while True:
+		await asyncio.sleep(1)
+		counts.append(counters["messages"])
+		del counts[0]
+		messageRate = (counts[-1] - counts[0]) / (len(counts) - 1)
+
+# PROFILING
+# /profile samples the stack of the event loop's thread from another thread every profileInterval seconds, which barely slows the server down, and writes how often each stack was seen as collapsed stacks.
+# (One line per stack, from the outermost to the innermost function separated by semicolons, followed by the number of samples. flamegraph.pl and speedscope can turn that into a flame graph.)
+# Independently of that, every callback that blocks the event loop for longer than slowCallbackThreshold gets logged along with the client, room and frame it was for.
+
+# gets run in a worker thread.
+def sampleStacks(threadID, duration):
+	stacks = {}
+	names = {} # maps code objects to their name in the stacks
+	deadline = time.monotonic() + duration
+	while time.monotonic() < deadline:
+		frame = sys._current_frames().get(threadID)
+		stack = []
+		while frame is not None:
+			code = frame.f_code
+			if code not in names:
+				names[code] = os.path.basename(code.co_filename) + ":" + code.co_name
+			stack.append(names[code])
+			frame = frame.f_back
+		stack.reverse()
+		stack = ";".join(stack)
+		stacks[stack] = stacks.get(stack, 0) + 1
+		time.sleep(profileInterval)
+	return stacks
+
+# gets run in a worker thread. Returns the path of the file that got written.
+def writeProfile(stacks):
+	os.makedirs(profileDirectory, exist_ok = True)
+	path = os.path.join(profileDirectory, "profile-" + str(workerID) + "-" + time.strftime("%Y%m%d-%H%M%S") + ".folded")
+	with open(path, "w", encoding = "utf-8") as file:
+		for stack, count in sorted(stacks.items(), key = lambda item: item[1], reverse = True):
+			file.write(stack + " " + str(count) + "\n")
+	return path
+
+# runs in a copy of the context of the admin that used /profile, so they get told where the profile went.
+async def takeProfile(duration):
+	global profiling
+	loop = asyncio.get_event_loop()
+	try:
+		stacks = await loop.run_in_executor(None, sampleStacks, threading.get_ident(), duration)
+		path = await loop.run_in_executor(None, writeProfile, stacks)
+		result = "Wrote profile with " + str(sum(stacks.values())) + " samples to " + path + "."
+	except OSError as error:
+		result = "Could not write profile: " + str(error)
+	finally:
+		profiling = False
+	print(result)
+	replyInfo(result)
+
+# makes every callback that the event loop runs measure how long it took. (Coroutines run as one callback from one await to the next.)
+# This relies on internals of asyncio, so if they aren't there (on other Python versions or event loops), slow callbacks just don't get logged.
+def installSlowCallbackLog():
+	runCallback = getattr(asyncio.events.Handle, "_run", None)
+	if runCallback is None:
+		print("Slow callbacks can't be logged with this version of asyncio.")
+		return
+	
+	def runTimedCallback(handle):
+		callbackStart = time.perf_counter()
+		runCallback(handle)
+		duration = time.perf_counter() - callbackStart
+		if duration >= slowCallbackThreshold:
+			logSlowCallback(handle, duration)
+	
+	asyncio.events.Handle._run = runTimedCallback
+
+def logSlowCallback(handle, duration):
+	context = getattr(handle, "_context", None) or {}
+	callback = getattr(handle, "_callback", None)
+	task = getattr(callback, "__self__", None)
+	if context.get(activity):
+		description = "handling " + context.get(activity)
+	elif isinstance(task, asyncio.Task):
+		description = "in " + task.get_coro().__qualname__
+	else:
+		description = "in " + getattr(callback, "__qualname__", repr(callback))
+	connection = context.get(client)
+	if connection:
+		description += " for " + str(connection.userID or connection.id)
+		if connection.room:
+			description += " in room " + str(connection.room.id) + " (" + connection.room.name + ")"
+	description = "Slow callback: " + format(duration * 1000, ".1f") + "ms " + description
+	counters["slowCallbacks"] += 1
+	slowCallbacks.append(description)
+	print(description)
+
+# ASSETS
+# The emoji and room icons can be served over HTTP, along with a sprite atlas that has all of them in one image and a manifest (atlas.json) that says where to find them.
+# Every URL in the manifest has ?v=<ETag> at the end. Those URLs never change their content, so clients can cache them forever.
+
+# returns the name that an emoji file is used under in <sprite name=...>. (GunLeft.png is gun_left)
+def spriteName(fileName):
+	stem = os.path.splitext(fileName)[0]
+	if stem in spriteNameOverrides:
+		return spriteNameOverrides[stem]
+	return re.sub("(?<=[a-z])(?=[A-Z])", "_", stem).lower()
+
+# returns the paths and modification times of all asset files so that changes can be noticed.
+def assetFiles():
+	files = []
+	for urlPath, directory in assetDirectories.items():
+		# the working directory isn't necessarily the one the assets are in
+		directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
+		for fileName in sorted(os.listdir(directory)):
+			path = os.path.join(directory, fileName)
+			# _template.png and the like aren't actual assets
+			if fileName.lower().endswith(".png") and not fileName.startswith("_") and os.path.isfile(path):
+				files.append((urlPath, fileName, path, os.path.getmtime(path)))
+	return files
+
+def makeAsset(body, contentType):
+	return (body, hashlib.sha256(body).hexdigest()[:16], contentType)
+
+# gets run in a worker thread. Returns everything that goes into assets{}.
+def buildAssets(files):
+	newAssets = {}
+	images = [] # (kind, name, URL, image) for everything that goes into the atlas
+	iconIndices = {iconFileNames.get(name, name): index for index, name in enumerate(iconNames)}
+	for urlPath, fileName, path, modified in files:
+		with open(path, "rb") as file:
+			url = "/" + urlPath + "/" + fileName
+			newAssets[url] = makeAsset(file.read(), "image/png")
+		if urlPath == "emoji":
+			images.append(("sprites", spriteName(fileName), url, path))
+		elif os.path.splitext(fileName)[0].lower() in iconIndices:
+			images.append(("icons", str(iconIndices[os.path.splitext(fileName)[0].lower()]), url, path))
+	
+	manifest = {"sprites": {}, "icons": {}}
+	for kind, name, url, path in images:
+		manifest[kind][name] = {"url": url + "?v=" + newAssets[url][1]}
+	
+	if Image is not None:
+		# pack everything into rows, tallest images first
+		loaded = sorted(((kind, name, loadImage(path)) for kind, name, url, path in images), key = lambda entry: -entry[2].height)
+		x = y = rowHeight = 0
+		positions = []
+		for kind, name, image in loaded:
+			if x + image.width > atlasWidth and x > 0:
+				x = 0
+				y += rowHeight + atlasPadding
+				rowHeight = 0
+			positions.append((x, y))
+			manifest[kind][name]["atlas"] = [x, y, image.width, image.height]
+			x += image.width + atlasPadding
+			rowHeight = max(rowHeight, image.height)
+		
+		atlas = Image.new("RGBA", (atlasWidth, max(1, y + rowHeight)))
+		for (kind, name, image), position in zip(loaded, positions):
+			atlas.paste(image, position)
+		atlasFile = io.BytesIO()
+		atlas.save(atlasFile, "PNG", optimize = True)
+		newAssets["/atlas.png"] = makeAsset(atlasFile.getvalue(), "image/png")
+		manifest["atlas"] = {"url": "/atlas.png?v=" + newAssets["/atlas.png"][1], "width": atlas.width, "height": atlas.height}
+	
+	newAssets["/atlas.json"] = makeAsset(json.dumps(manifest, indent = 4).encode("utf-8"), "application/json")
+	return newAssets
+
+# returns the image at path as RGBA, without keeping the file open.
+def loadImage(path):
+	with Image.open(path) as image:
+		return image.convert("RGBA")
+
+async def serveAsset(request):
+	asset = assets.get(request.path)
+	if asset is None:
+		raise web.HTTPNotFound()
+	body, etag, contentType = asset
+	headers = {
+		"ETag": "\"" + etag + "\"",
+		# only versioned URLs can be cached forever, everything else needs to check if it is still up to date
+		"Cache-Control": "public, max-age=31536000, immutable" if request.query.get("v") == etag else "no-cache"
+	}
+	if request.headers.get("If-None-Match") == headers["ETag"]:
+		return web.Response(status = 304, headers = headers)
+	return web.Response(body = body, content_type = contentType, headers = headers)
+
+async def startAssetServer(host, port):
+	global assets
+	global assetRunner
+	try:
+		files = assetFiles()
+	except OSError as error:
+		# the chat works without it
+		print("Could not read the assets, so the asset server won't start: " + str(error))
+		return
+	assets = await asyncio.get_event_loop().run_in_executor(None, buildAssets, files)
+	if Image is None:
+		print("Pillow is not installed, so the sprite atlas won't be built.")
 	
-	with open("rooms.json", "w", encoding = "utf-8") as file:
-		json.dump(roomsObject, file, ensure_ascii = False, indent = 4)
+	app = web.Application()
+	app.router.add_get("/{path:.*}", serveAsset)
+	assetRunner = web.AppRunner(app, access_log = None)
+	await assetRunner.setup()
+	await web.TCPSite(assetRunner, host, port).start()
+	asyncio.ensure_future(watchAssets(files))
+
+# rebuilds the assets whenever a file in the assetDirectories gets added, removed or changed.
+async def watchAssets(files):
+	global assets
+	while True:
+		await asyncio.sleep(assetCheckInterval)
+		try:
+			newFiles = await asyncio.get_event_loop().run_in_executor(None, assetFiles)
+			if newFiles != files:
+				assets = await asyncio.get_event_loop().run_in_executor(None, buildAssets, newFiles)
+				files = newFiles
+				print("Rebuilt assets.")
+		except OSError as error:
+			print("Could not rebuild assets: " + str(error))
+
+# TRAFFIC RECORDING
+# With --record, every frame that clients send gets written to a log so that busy times can be replayed against a local server later. (see replay.py)
+# Every line is "<time> <connection> <kind> <frame>". The time is from time.monotonic(), so that the files of several workers can be merged, and the connection is <process ID>:<connection ID> so that it stays unique across handoffs.
+# The kind is c when the connection was opened, f for a frame (which follows as a JSON string) and d when it was closed. Files start with a line that begins with #.
+# Only what clients send gets recorded, so the codes from vrf: messages never end up in it.
+
+class TrafficRecorder:
+	def __init__(self, path):
+		self.path = path
+		self.prefix = str(os.getpid()) + ":"
+		self.pending = [] # lines that still need to be written
+		self.open()
+	
+	def open(self):
+		# unbuffered and in append mode, so that every flush is a single write of whole lines. (Two processes write to the same file during a handoff.)
+		self.file = open(self.path, "ab", buffering = 0)
+		if self.file.tell() == 0:
+			self.file.write(("# nChat traffic recording, started " + time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()) + "\n").encode("utf-8"))
+	
+	def record(self, connectionID, kind, frame = None):
+		line = format(time.monotonic(), ".3f") + " " + self.prefix + str(connectionID) + " " + kind
+		if frame is not None:
+			# whatever a client puts after [verify] gets cut off since it might be a verification code
+			if frame.startswith("[verify]"):
+				frame = "[verify]"
+			line += " " + json.dumps(frame, ensure_ascii = False)
+		self.pending.append((line + "\n").encode("utf-8"))
+	
+	def flush(self):
+		if len(self.pending) > 0:
+			self.file.write(b"".join(self.pending))
+			self.pending = []
+		if self.file.tell() >= recordFileSize:
+			self.rotate()
+	
+	# moves the record file to <path>.1 (and that one to <path>.2 and so on, dropping the oldest one) and starts a new one.
+	def rotate(self):
+		self.file.close()
+		for number in range(recordFileCount - 1, 0, -1):
+			if os.path.exists(self.path + "." + str(number)):
+				os.replace(self.path + "." + str(number), self.path + "." + str(number + 1))
+		if recordFileCount > 0:
+			os.replace(self.path, self.path + ".1")
+		else:
+			os.remove(self.path)
+		self.open()
+	
+	async def flushContinuously(self):
+		while True:
+			await asyncio.sleep(recordFlushInterval)
+			try:
+				self.flush()
+			except OSError as error:
+				print("Could not write traffic recording: " + str(error))
+	
+	def close(self):
+		self.flush()
+		self.file.close()
+
+# EVENTS
+# Everything that changes rooms (or admins) goes through the backplane as an event so that, when running with --workers, every worker applies the same changes in the same order.
+# An event is a JSON-serializable dict with a "type" and gets applied by the function for that type in eventHandlers. Those must not await anything.
+# Rooms and connections are referred to by their IDs, connections only exist on the worker they are connected to.
+
+def applyEvent(event):
+	return eventHandlers[event["type"]](event)
+
+# returns the new room or an error string.
+def applyCreateRoom(event):
+	global lastRoomID
+	# validate room
+	if len(rooms) >= roomLimit:
+		return "Room cap reached, cannot create more rooms."
+	name = event["name"]
+	if len(name) == 0:
+		name = "Unnamed Room #" + str(lastRoomID)
+	
+	# create the room
+	lastRoomID += 1
+	room = Room(lastRoomID, name, event["owner"], event["icon"], event["messageLimit"], event["alwaysOpen"], event["badWords"], event["readOnly"], event["historyKey"])
+	rooms[room.id] = room
+	lobbyChanged(room, "room")
+	
+	# add user to the room
+	if event["connection"] is not None:
+		addUserToRoom(room, event["connection"])
+	return room
+
+# returns the room or None if it doesn't exist anymore.
+def applyJoinRoom(event):
+	room = rooms.get(event["room"])
+	if room:
+		addUserToRoom(room, event["connection"])
+		connection = eventConnection(event["connection"])
+		if connection:
+			# send all old messages of the room to the new user
+			if event["replayAmount"] is not None:
+				sendHistory(connection.websocket, room.messages, room.messages.total, event["replayAmount"])
+			else:
+				sendBatch(connection.websocket, (message.decode("utf-8") for message in room.messages))
+	return room
+
+def addUserToRoom(room, key):
+	room.userCount += 1
+	lobbyChanged(room, "userCount")
+	connection = eventConnection(key)
+	if connection:
+		room.users.add(connection.websocket)
+		send(connection.websocket, "jnd:" + "<noparse=" + str(len(room.name)) + ">" + room.name)
+
+def applyLeaveRoom(event):
+	room = rooms[event["room"]]
+	room.userCount -= 1
+	connection = eventConnection(event["connection"])
+	if connection:
+		room.users.discard(connection.websocket)
+	if room.userCount == 0 and not room.alwaysOpen:
+		del rooms[room.id]
+		lobbyChanged(room, "removed")
+	else:
+		lobbyChanged(room, "userCount")
+
+def applyMessage(event):
+	counters["messages"] += 1
+	room = rooms[event["room"]]
+	encoded = event["message"].encode("utf-8")
+	addToHistory(room, event["message"], encoded)
+	broadcast(room.users, encoded)
+
+def applyUpdateRoom(event):
+	room = rooms.get(event["room"])
+	if not room:
+		return
+	changes = event["changes"]
+	
+	if "name" in changes:
+		# set room name and inform all users in the room
+		room.name = changes["name"]
+		broadcast(room.users, "nme:" + "<noparse=" + str(len(room.name)) + ">" + room.name)
+	if "icon" in changes:
+		room.icon = changes["icon"]
+	if "owner" in changes:
+		room.owner = changes["owner"]
+	if "readOnly" in changes:
+		room.readOnly = changes["readOnly"]
+	# adding and removing single words is sent as just that change so that two of them at once (on different workers) can't undo each other
+	if "badWords" in changes:
+		room.badWords = list(changes["badWords"])
+	if "addBadWord" in changes:
+		room.badWords = room.badWords + [changes["addBadWord"]]
+	if "removeBadWord" in changes and changes["removeBadWord"] in room.badWords:
+		room.badWords = list(room.badWords)
+		room.badWords.remove(changes["removeBadWord"])
+	if "badWords" in changes or "addBadWord" in changes or "removeBadWord" in changes:
+		room.badWordFilter = compileBadWords(room.badWords)
+	if "messageLimit" in changes:
+		oldest = room.messages.total - len(room.messages)
+		for sequence, message in enumerate(room.messages.resize(changes["messageLimit"]), oldest):
+			room.searchIndex.remove(sequence, message.decode("utf-8"))
+	if "alwaysOpen" in changes and changes["alwaysOpen"] != room.alwaysOpen:
+		room.alwaysOpen = changes["alwaysOpen"]
+		if historyLog:
+			if room.alwaysOpen:
+				# start logging the room's history
+				history = room.messages
+				for sequence, message in enumerate(history, history.total - len(history)):
+					historyLog.add(room, sequence, message.decode("utf-8"))
+			else:
+				# the logged history won't be needed anymore
+				historyLog.clear(room)
+	if "name" in changes or "icon" in changes or "owner" in changes:
+		lobbyChanged(room, "room")
+	
+	# save default (always open) rooms to file if necessary
+	if room.alwaysOpen:
+		saveDefaultRooms()
+
+def applyClearHistory(event):
+	room = rooms[event["room"]]
+	room.messages.clear()
+	room.searchIndex.clear()
+	if historyLog and room.alwaysOpen:
+		historyLog.clear(room)
+	# inform all users in the room
+	broadcast(room.users, "clr")
+
+# like bad words, admins get added and removed one at a time instead of replacing the whole list.
+def applyUpdateAdmins(event):
+	if "add" in event and event["add"] not in globalAdmins:
+		globalAdmins.append(event["add"])
+	if "remove" in event and event["remove"] in globalAdmins and event["remove"] not in alwaysAdmins:
+		globalAdmins.remove(event["remove"])
+
+# removes a room if it is still empty. (rooms normally get removed when their last user leaves, this is for rooms that got handed off but nobody came back to)
+def applyRemoveRoom(event):
+	room = rooms.get(event["room"])
+	if room and room.userCount == 0 and not room.alwaysOpen:
+		del rooms[room.id]
+		lobbyChanged(room, "removed")
+
+eventHandlers = {
+	"createRoom": applyCreateRoom,
+	"joinRoom": applyJoinRoom,
+	"leaveRoom": applyLeaveRoom,
+	"message": applyMessage,
+	"updateRoom": applyUpdateRoom,
+	"clearHistory": applyClearHistory,
+	"updateAdmins": applyUpdateAdmins,
+	"removeRoom": applyRemoveRoom
+}
+
+# the backplane for running as a single process, which just applies every event right away.
+class LocalBackplane:
+	async def publish(self, event):
+		return applyEvent(event)
+
+# the backplane for running with --workers, which sends events through the broker (see runBroker()) that all workers are connected to.
+# The broker sends every event back to all workers (including the one it came from) in the same order, and only then does it get applied.
+class BrokerBackplane:
+	def __init__(self, path):
+		self.path = path
+		self.reader = None
+		self.writer = None
+		self.lastToken = 0
+		self.waiting = {} # maps the tokens of events this worker published to the futures waiting for them to be applied
+	
+	# connects to the broker and waits until all other workers have done the same.
+	async def connect(self):
+		self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit = brokerLineLimit)
+		await self.reader.readline() # the broker sends an empty line once all workers are connected
+	
+	# returns whatever applying the event returned, once it has been applied.
+	async def publish(self, event):
+		self.lastToken += 1
+		event["origin"] = workerID
+		event["token"] = self.lastToken
+		applied = asyncio.get_event_loop().create_future()
+		self.waiting[self.lastToken] = applied
+		self.writer.write(json.dumps(event, ensure_ascii = False).encode("utf-8") + b"\n")
+		return await applied
+	
+	async def receiveContinuously(self):
+		while True:
+			line = await self.reader.readline()
+			if not line:
+				raise ConnectionError("Lost the connection to the broker.")
+			event = json.loads(line)
+			try:
+				result = applyEvent(event)
+			except Exception as error:
+				traceback.print_exc()
+				result = error
+			if event["origin"] == workerID:
+				applied = self.waiting.pop(event["token"])
+				if applied.done():
+					continue
+				if isinstance(result, Exception):
+					applied.set_exception(result)
+				else:
+					applied.set_result(result)
 
 # websocket function
 async def takeClient(websocket, path):
 	global rooms
+	global lastConnectionID
+	if len(connections) >= connectionLimit:
+		await websocket.send("err:The server is full. Please try again later.")
+		await websocket.close(1013, closeReasons[1013])
+		return
 	print("Client connected.")
-	socket.set(websocket)
-	verified.set(False)
-	await websocket.send("lft")
+	lastConnectionID += 1
+	client.set(Connection(websocket, lastConnectionID))
+	connections[client.get().id] = client.get()
+	outboxes[websocket] = asyncio.Queue()
+	writer = asyncio.ensure_future(writeOutbox(websocket, outboxes[websocket]))
+	now = time.monotonic()
+	rateBuckets = {kind: TokenBucket(limit, now) for kind, limit in connectionRateLimits.items()}
+	if recorder:
+		recorder.record(client.get().id, "c")
+	reply("lft")
 	await refreshRoomList()
 	
 	# ask client to verify themselves with a new verification key
 	verificationCode = base64.b64encode(os.urandom(32)).decode("utf-8")
-	await websocket.send("vrf:" + verificationCode)
+	reply("vrf:" + verificationCode)
 	try:
 		async for message in websocket:
+			if client.get().userID is not None:
+				client.get().lastActive = reapRound
+			if recorder:
+				recorder.record(client.get().id, "f", message)
+			if handingOff: # the rooms might already be on their way to the new process
+				continue
+			activity.set(message.partition(" ")[0] if message.startswith("[message]/") else message[:message.find("]") + 1])
 			if message.startswith("[message]"): # sending a message
 				# cut out the initial [message]
 				message = message[9:]
-				async with roomLock:
-					if currentRoom.get():
+				if client.get().room:
+					if not takeToken(rateBuckets, "chat"):
+						reply("err:You are sending messages too quickly. Please slow down.")
+						continue
+					async with client.get().room.lock:
 						# check if the room is readOnly
-						if currentRoom.get()["readOnly"] and (currentRoom.get()["owner"] != userID.get() or not verified.get()):
-							await socket.get().send("err:This room is read-only. You must be the verified owner of this room to send messages here.")
+						if client.get().room.readOnly and (client.get().room.owner != client.get().userID or not client.get().verified):
+							reply("err:This room is read-only. You must be the verified owner of this room to send messages here.")
 							continue
 						
 						if message.startswith("/"):
@@ -561,81 +2056,473 @@ async def takeClient(websocket, path):
 							# check if command exists
 							if command not in slashCommands:
 								# send red message and an error back
-								await websocket.send("err:The entered command does not exist.")
-								await websocket.send("msg:" + userID.get() + "|" + str(verified.get()) + "|<color=#fbb><noparse=" + str(len(message)) + ">" + message)
+								reply("err:The entered command does not exist.")
+								reply("msg:" + client.get().userID + "|" + str(client.get().verified) + "|<color=#fbb><noparse=" + str(len(message)) + ">" + message)
 								continue
 							params = message[message.find(" ") + 1:] if message.find(" ") > 0 else ""
 							messageColor = "bfb" if await slashCommands[command](params) else "fbb"
 							# send colored command message back
-							await websocket.send("msg:" + userID.get() + "|" + str(verified.get()) + "|<color=#" + messageColor + "><noparse=" + str(len(message)) + ">" + message)
+							reply("msg:" + client.get().userID + "|" + str(client.get().verified) + "|<color=#" + messageColor + "><noparse=" + str(len(message)) + ">" + message)
 						else:
 							await sendMessage(message)
 			elif message.startswith("[join]"): # joining a room
 				# if user is already in a room, ignore this message
-				if currentRoom.get():
-					await websocket.send("err:Cannot join a room when already in a room.")
+				if client.get().room:
+					reply("err:Cannot join a room when already in a room.")
+					continue
+				# newer clients can add how many old messages they want and get them in batches, older ones just get sent every old message on its own.
+				roomID, _, replayAmount = message[6:].partition("|")
+				try:
+					roomID = int(roomID)
+				except ValueError:
+					reply("err:Could not understand which room to join.")
 					continue
-				roomID = int(message[6:])
-				async with roomLock:
-					room = next((room for room in rooms if room["id"] == roomID), None)
+				if replayAmount:
+					replayAmount = parseHistoryAmount(replayAmount)
+					if replayAmount is None:
+						reply("err:Could not understand how many old messages to send.")
+						continue
+				else:
+					replayAmount = None
+				async with registryLock:
+					room = rooms.get(roomID)
+					if room:
+						async with room.lock:
+							room = await backplane.publish({"type": "joinRoom", "room": roomID, "connection": connectionKey(client.get()), "replayAmount": replayAmount})
 					if room:
-						currentRoom.set(room)
-						room["users"].append(websocket)
-						await websocket.send("jnd:" + "<noparse=" + str(len(room["name"])) + ">" + room["name"])
-						# send all old messages of the room to the new user
-						for message in room["messages"]:
-							await websocket.send(message)
+						client.get().room = room
 					else:
-						await websocket.send("err:The room you tried to join does not exist anymore.")
+						reply("err:The room you tried to join does not exist anymore.")
+			elif message.startswith("[history]"): # client wants older messages from the room it is in
+				if client.get().room:
+					if not takeToken(rateBuckets, "refresh"):
+						reply("err:You are asking for old messages too often. Please wait a bit.")
+						continue
+					before, _, amount = message[9:].partition("|") # [0] is the sequence number from an earlier hst: message, [1] is how many messages to send.
+					try:
+						before = int(before)
+					except ValueError:
+						before = None
+					amount = parseHistoryAmount(amount)
+					if before is None or amount is None:
+						reply("err:Could not understand which messages to send.")
+						continue
+					async with client.get().room.lock:
+						sendHistory(websocket, client.get().room.messages, before, amount)
 			elif message.startswith("[leave]"): # leaving a room
-				async with roomLock:
-					if currentRoom.get():
-						currentRoom.get()["users"].remove(websocket)
-						if len(currentRoom.get()["users"]) == 0 and not currentRoom.get()["alwaysOpen"]:
-							rooms.remove(currentRoom.get())
-						currentRoom.set(None)
+				await leaveCurrentRoom()
 				# after removing them from the room, inform the client.
-				await websocket.send("lft")
-				await refreshRoomList()
+				reply("lft")
+				# subscribers already have an up-to-date room list
+				if websocket not in lobbySubscribers:
+					await refreshRoomList()
 			elif message.startswith("[room]"): # creating a room
+				if not takeToken(rateBuckets, "room"):
+					reply("err:You are creating rooms too quickly. Please wait a bit.")
+					continue
 				roomParams = message[6:].split("|") # [0] is the name, [1] is the icon.
-				error = await createNewRoom(roomParams[0], int(roomParams[1]), userID.get())
+				error = await createNewRoom(roomParams[0], int(roomParams[1]), client.get().userID)
 				if error: # if a string got returned, it is an error
-					await websocket.send("err:" + error)
+					reply("err:" + error)
 			elif message.startswith("[refresh]"): # client wants to refresh their room list
-				await refreshRoomList()
+				# too many refreshes just get ignored since the client still has the last room list
+				if takeToken(rateBuckets, "refresh"):
+					await refreshRoomList()
+			elif message.startswith("[rooms]"): # client wants one page of the room list, filtered and sorted, instead of all of it
+				# [rooms]<sort>|<page size>|<cursor>|<icon>|<owner>|<name>, where everything can be left empty. Sort is "users" (most users first, the default) or "new" (newest first).
+				# The answer is a dir: message with the cursor for the next page (empty if this is the last one) followed by a rom: message for every room on this page.
+				# unlike a [refresh], this can't just get ignored since the client is waiting for the page
+				if not takeToken(rateBuckets, "refresh"):
+					reply("err:You are asking for the room list too often. Please wait a bit.")
+					continue
+				sendRoomDirectory(*(message[7:].split("|", 5) + [""] * 5)[:6])
+			elif message.startswith("[subscribe]"): # client wants to be told about changes to the room list instead of asking with [refresh]
+				# rom: messages add or replace a room, usr:<id>|<count> changes the user count of a room and rmv:<id> removes a room.
+				# subscribing always works, only sending the whole room list again counts as a refresh (a client that asks too often still has the last one)
+				lobbySubscribers.add(websocket)
+				if takeToken(rateBuckets, "refresh"):
+					await refreshRoomList()
 			elif message.startswith("[iam]"): # client identifies themselves (this DOES NOT verify them)
-				userID.set(message[5:])
+				# verification only holds for the userID that got verified
+				if message[5:] != client.get().userID:
+					client.get().verified = False
+				client.get().userID = sys.intern(message[5:])
 			elif message.startswith("[verify]"): # client claims to have verified themselves
-				async with aiohttp.ClientSession() as session:
-					# ask Neos API for their cloud var
-					async with session.post("https://api.neos.com/api/readvars", json = [{"ownerId": userID.get(), "path": "U-Psychpsyo.verificationCode"}]) as response:
-						jsonData = await response.json()
-						# if they set it to the verificationCode, set them to verified.
-						if jsonData[0].get("variable", {}).get("value", None) == verificationCode:
-							verified.set(True)
+				if not takeToken(rateBuckets, "verify"):
+					reply("err:You are trying to verify too often. Please wait a bit.")
+					continue
+				try:
+					cloudVerificationCode = await verificationClient.readVerificationCode(client.get().userID)
+				except (aiohttp.ClientError, asyncio.TimeoutError):
+					reply("err:Could not reach the Neos API to verify you. Please try again later.")
+					continue
+				# if they set it to the verificationCode, set them to verified.
+				if cloudVerificationCode == verificationCode:
+					client.get().verified = True
 	except:
 		pass
 	
 	# user disconnected so it's time to clean up after them.
-	async with roomLock:
-		if currentRoom.get():
-			currentRoom.get()["users"].remove(websocket)
-			if len(currentRoom.get()["users"]) == 0 and not currentRoom.get()["alwaysOpen"]:
-				rooms.remove(currentRoom.get())
-
-loop = asyncio.get_event_loop()
-
-# create the always-open default rooms
-print("Creating default rooms.")
-with open("rooms.json") as jsonFile:
-	jsonData = json.load(jsonFile)
-	for room in jsonData["rooms"]:
-		loop.run_until_complete(createNewRoom(room["name"], room["icon"], room["owner"], bySystem = True, messageLimit = room.get("messageLimit", 100), readOnly = room["readOnly"], badWords = room.get("badWords", [])))
-
-# start websocket and listen
-print("Starting websocket.")
-start_server = websockets.serve(takeClient, "localhost", 32759)
-
-loop.run_until_complete(start_server)
-loop.run_forever()
\ No newline at end of file
+	if recorder:
+		recorder.record(client.get().id, "d")
+	lobbySubscribers.discard(websocket)
+	outboxes.pop(websocket, None)
+	writer.cancel()
+	# during a handoff the client is coming back to the new process, so its room shouldn't get removed
+	if not handingOff:
+		await leaveCurrentRoom()
+	del connections[client.get().id]
+
+# HANDOFF
+# Restarts the server without dropping the rooms or their history: A new server process gets started on the same listening sockets (so no connections get refused in between) and all clients get sent an rcn: message and disconnected so that they reconnect to it.
+# Once they are gone, the rooms get sent to the new process through its stdin.
+
+def snapshotRooms():
+	return {
+		"lastRoomID": lastRoomID,
+		"admins": globalAdmins,
+		"rooms": [{
+			"id": room.id,
+			"name": room.name,
+			"owner": room.owner,
+			"icon": room.icon,
+			"alwaysOpen": room.alwaysOpen,
+			"badWords": room.badWords,
+			"readOnly": room.readOnly,
+			"historyKey": room.historyKey,
+			"messageLimit": room.messages.limit,
+			"total": room.messages.total,
+			"messages": [message.decode("utf-8") for message in room.messages]
+		} for room in rooms.values()]
+	}
+
+# rebuilds the rooms from a snapshotRooms() of the old process. Returns the IDs of the rooms that only stay open while they have users.
+def restoreRooms(snapshot):
+	global lastRoomID
+	temporaryRooms = []
+	for savedRoom in snapshot["rooms"]:
+		lastRoomID = savedRoom["id"] - 1 # so that the room keeps its ID and clients can join it again
+		room = applyEvent({
+			"type": "createRoom",
+			"name": savedRoom["name"],
+			"icon": savedRoom["icon"],
+			"owner": savedRoom["owner"],
+			"alwaysOpen": savedRoom["alwaysOpen"],
+			"messageLimit": savedRoom["messageLimit"],
+			"readOnly": savedRoom["readOnly"],
+			"badWords": savedRoom["badWords"],
+			"historyKey": savedRoom["historyKey"],
+			"connection": None
+		})
+		# so that sequence numbers continue where they left off
+		room.messages.total = savedRoom["total"] - len(savedRoom["messages"])
+		for message in savedRoom["messages"]:
+			appendMessage(room, message, message.encode("utf-8"))
+		if not room.alwaysOpen:
+			temporaryRooms.append(room.id)
+	lastRoomID = snapshot["lastRoomID"]
+	globalAdmins[:] = snapshot["admins"]
+	return temporaryRooms
+
+async def removeEmptyRoomsLater(roomIDs):
+	await asyncio.sleep(handoffGracePeriod)
+	async with registryLock:
+		for roomID in roomIDs:
+			await backplane.publish({"type": "removeRoom", "room": roomID})
+
+# picks the rooms back up after a handoff failed. The clients that left were told to reconnect, so like in the new process, rooms that are empty now stay open for a while so they can rejoin them.
+def takeBackRooms():
+	emptyRooms = []
+	for room in list(rooms.values()):
+		room.users = {websocket for websocket in room.users if websocket in outboxes}
+		room.userCount = len(room.users)
+		lobbyChanged(room, "userCount")
+		if room.userCount == 0 and not room.alwaysOpen:
+			emptyRooms.append(room.id)
+	asyncio.ensure_future(removeEmptyRoomsLater(emptyRooms))
+
+# hands everything off to a new server process that gets started with arguments and stops this one. (only works when running as a single process)
+# If the new process can't be started or doesn't get to the point where it accepts connections, this one keeps running and resume() gets called with the listening sockets to serve on them again.
+async def handOff(servers, arguments, resume):
+	global handingOff
+	if handingOff:
+		return
+	handingOff = True
+	print("Handing off to a new server process.")
+	
+	# start the new process right away so that it can get ready while the clients disconnect.
+	listeningSockets = [os.dup(listeningSocket.fileno()) for server in servers for listeningSocket in server.sockets]
+	readyPipe, readyPipeEnd = os.pipe() # the new process writes to this once it accepts connections
+	try:
+		newProcess = subprocess.Popen(arguments + ["--handoff", ",".join(str(fileDescriptor) for fileDescriptor in listeningSockets), "--handoff-ready", str(readyPipeEnd)], stdin = subprocess.PIPE, pass_fds = listeningSockets + [readyPipeEnd])
+	except OSError as error:
+		print("Could not start the new server process, so this one keeps running: " + str(error))
+		for fileDescriptor in listeningSockets + [readyPipe, readyPipeEnd]:
+			os.close(fileDescriptor)
+		handingOff = False
+		return
+	os.close(readyPipeEnd)
+	for server in servers:
+		server.server.close() # stops accepting connections without closing the ones that are open
+	
+	# tell every client to reconnect (and which room to rejoin) and wait for them to be gone
+	for connection in connections.values():
+		send(connection.websocket, "rcn:" + (str(connection.room.id) if connection.room else ""))
+		closeClient(connection.websocket, 1012)
+	drainDeadline = time.monotonic() + handoffDrainTimeout
+	while len(connections) > 0 and time.monotonic() < drainDeadline:
+		await asyncio.sleep(0.05)
+	
+	# nothing can change anymore, so everything still unsaved can get saved and the rooms can be sent over.
+	await flushDefaultRooms()
+	if historyLog:
+		await historyLog.flush()
+	# the new process only starts these once it has the rooms
+	if metricsRunner:
+		await metricsRunner.cleanup()
+	if assetRunner:
+		await assetRunner.cleanup()
+	try:
+		if newProcess.poll() is not None:
+			raise ChildProcessError("it exited with code " + str(newProcess.returncode))
+		newProcess.stdin.write(json.dumps(snapshotRooms(), separators = (",", ":")).encode("utf-8"))
+		newProcess.stdin.close()
+		try:
+			ready = await asyncio.wait_for(asyncio.get_event_loop().run_in_executor(None, os.read, readyPipe, 1), handoffReadyTimeout)
+		except asyncio.TimeoutError:
+			raise ChildProcessError("it didn't accept connections within " + str(handoffReadyTimeout) + " seconds")
+		if not ready: # it closed the pipe without writing to it, by exiting
+			raise ChildProcessError("it exited with code " + str(newProcess.wait()))
+	except OSError as error: # BrokenPipeError if it exited before it read the rooms
+		print("Handing off failed, so this process keeps running: " + str(error))
+		if newProcess.poll() is None:
+			newProcess.kill()
+		newProcess.wait()
+		os.close(readyPipe)
+		takeBackRooms()
+		await resume(listeningSockets)
+		handingOff = False
+		return
+	os.close(readyPipe)
+	for fileDescriptor in listeningSockets:
+		os.close(fileDescriptor)
+	print("Handed off to process " + str(newProcess.pid) + ".")
+	asyncio.get_event_loop().stop()
+
+brokerLineLimit = 2 ** 24 # the longest event (in bytes) that can go through the broker
+
+# relays events between all workers. Runs in the main process when running with --workers.
+async def runBroker(path, workerCount):
+	workers = []
+	
+	async def takeWorker(reader, writer):
+		workers.append(writer)
+		if len(workers) == workerCount:
+			for worker in workers:
+				worker.write(b"\n")
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			# no awaiting in here, so every worker gets the events in the same order.
+			for worker in workers:
+				worker.write(line)
+		workers.remove(writer)
+	
+	return await asyncio.start_unix_server(takeWorker, path, limit = brokerLineLimit)
+
+# runs the server as a single process (or as one of the workers when running with --workers)
+def runServer(host = "localhost", port = 32759, worker = 0, brokerPath = None, metrics = None, handoffSockets = None, assetServerPort = None, record = None, verificationURL = None, historyPath = None, handoffReady = None):
+	global workerID
+	global metricsPort
+	global assetPort
+	global recordPath
+	global recorder
+	global verificationEndpoint
+	global historyDatabase
+	global backplane
+	global historyLog
+	global verificationClient
+	workerID = worker
+	if metrics is not None:
+		metricsPort = metrics
+	if assetServerPort is not None:
+		assetPort = assetServerPort
+	if record is not None:
+		recordPath = record
+	if verificationURL is not None:
+		verificationEndpoint = verificationURL
+	if historyPath is not None:
+		historyDatabase = historyPath
+	loop = asyncio.get_event_loop()
+	backplane = LocalBackplane()
+	if slowCallbackThreshold is not None:
+		installSlowCallbackLog()
+	
+	if handoffSockets:
+		# take over the rooms of the old process once all of its clients are gone
+		print("Waiting for rooms from the old process.")
+		temporaryRooms = restoreRooms(json.load(sys.stdin))
+		asyncio.ensure_future(removeEmptyRoomsLater(temporaryRooms))
+		jsonData = {"rooms": []}
+	else:
+		# create the always-open default rooms
+		print("Creating default rooms.")
+		with open("rooms.json") as jsonFile:
+			jsonData = json.load(jsonFile)
+			for savedRoom in jsonData["rooms"]:
+				loop.run_until_complete(createNewRoom(savedRoom["name"], savedRoom["icon"], savedRoom["owner"], bySystem = True, messageLimit = savedRoom.get("messageLimit", 100), readOnly = savedRoom["readOnly"], badWords = savedRoom.get("badWords", []), historyKey = savedRoom.get("historyKey")))
+	
+	# load the message history of the default rooms
+	if historyDatabase:
+		historyLog = HistoryLog(historyDatabase)
+		# rooms from a handoff already have theirs
+		if not handoffSockets:
+			print("Loading message history.")
+			for room in rooms.values():
+				rows = historyLog.load(room, room.messages.limit)
+				if len(rows) > 0:
+					room.messages.total = rows[0][0] # so that sequence numbers continue where they left off
+				for sequence, message in rows:
+					appendMessage(room, message, message.encode("utf-8"))
+		if workerID == 0:
+			# rooms that didn't have a historyKey yet need theirs saved
+			if any("historyKey" not in savedRoom for savedRoom in jsonData["rooms"]):
+				saveDefaultRooms()
+			asyncio.ensure_future(historyLog.flushContinuously())
+		else:
+			# only the first worker writes to the historyDatabase
+			historyLog = None
+	
+	verificationClient = VerificationClient(verificationEndpoint)
+	asyncio.ensure_future(measureMessageRate())
+	asyncio.ensure_future(pruneUserBuckets())
+	asyncio.ensure_future(reapConnections())
+	if metricsPort is not None:
+		# every worker gets its own port
+		print("Serving metrics on port " + str(metricsPort + workerID) + ".")
+		loop.run_until_complete(startMetricsServer(host, metricsPort + workerID))
+	# the assets are the same for every worker, so only the first one serves them
+	if assetPort is not None and workerID == 0:
+		print("Serving assets on port " + str(assetPort) + ".")
+		loop.run_until_complete(startAssetServer(host, assetPort))
+	if recordPath is not None:
+		# every worker records to its own file
+		recorder = TrafficRecorder(recordPath + ("-" + str(workerID) if brokerPath else ""))
+		print("Recording traffic to " + recorder.path + ".")
+		asyncio.ensure_future(recorder.flushContinuously())
+	
+	# connect to the other workers
+	if brokerPath:
+		print("Connecting to broker.")
+		backplane = BrokerBackplane(brokerPath)
+		loop.run_until_complete(backplane.connect())
+		receiver = asyncio.ensure_future(backplane.receiveContinuously())
+		receiver.add_done_callback(lambda receiver: loop.stop())
+	
+	# start websocket and listen
+	print("Starting websocket.")
+	serveOptions = {
+		"compression": "deflate" if compression else None,
+		"ping_interval": pingInterval,
+		"ping_timeout": pingTimeout,
+		"close_timeout": closeTimeout,
+		"max_size": maxFrameSize,
+		"max_queue": inboundQueueSize,
+		"read_limit": readLimit,
+		"write_limit": writeLimit
+	}
+	if handoffSockets:
+		servers = [loop.run_until_complete(websockets.serve(takeClient, sock = Socket(fileno = fileDescriptor), **serveOptions)) for fileDescriptor in handoffSockets]
+		# let the old process know that it can stop
+		if handoffReady is not None:
+			os.write(handoffReady, b"\n")
+			os.close(handoffReady)
+	else:
+		servers = [loop.run_until_complete(websockets.serve(takeClient, host, port, reuse_port = brokerPath is not None, **serveOptions))]
+	
+	# serves on the listening sockets again (and restarts the metrics and asset servers) after a handoff failed
+	async def resumeServing(listeningSockets):
+		servers[:] = [await websockets.serve(takeClient, sock = Socket(fileno = fileDescriptor), **serveOptions) for fileDescriptor in listeningSockets]
+		if metricsPort is not None:
+			await startMetricsServer(host, metricsPort + workerID)
+		if assetPort is not None and workerID == 0:
+			await startAssetServer(host, assetPort)
+	
+	# stop cleanly on SIGTERM as well as Ctrl+C
+	try:
+		loop.add_signal_handler(signal.SIGTERM, loop.stop)
+		# restart without downtime on SIGUSR2
+		if not brokerPath:
+			arguments = [sys.executable, os.path.abspath(sys.argv[0]), "--host", host, "--port", str(port)] + (["--metrics-port", str(metricsPort)] if metricsPort is not None else []) + (["--asset-port", str(assetPort)] if assetPort is not None else []) + (["--record", recordPath] if recordPath is not None else []) + (["--history-database", historyDatabase] if historyDatabase is not None else []) + ["--verification-endpoint", verificationEndpoint]
+			loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(handOff(servers, arguments, resumeServing)))
+	except (NotImplementedError, AttributeError): # not supported on Windows
+		pass
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	
+	# make sure nothing that still needs to be saved gets lost
+	print("Shutting down.")
+	loop.run_until_complete(flushDefaultRooms())
+	loop.run_until_complete(verificationClient.close())
+	if historyLog:
+		loop.run_until_complete(historyLog.flush())
+	if recorder:
+		recorder.close()
+
+# runs the broker and workerCount worker processes that all accept connections on the same port. (only works on Linux)
+# If any of the workers stops, all of them get stopped.
+def runWorkers(workerCount, host, port, metrics, assetServerPort, record, verificationURL, historyPath):
+	loop = asyncio.get_event_loop()
+	brokerPath = os.path.join(tempfile.mkdtemp(), "broker.sock")
+	loop.run_until_complete(runBroker(brokerPath, workerCount))
+	
+	processContext = multiprocessing.get_context("spawn")
+	workers = [processContext.Process(target = runServer, args = (host, port, worker, brokerPath, metrics, None, assetServerPort, record, verificationURL, historyPath)) for worker in range(workerCount)]
+	for worker in workers:
+		worker.start()
+	
+	async def watchWorkers():
+		while all(worker.is_alive() for worker in workers):
+			await asyncio.sleep(1)
+		loop.stop()
+	
+	asyncio.ensure_future(watchWorkers())
+	try:
+		loop.add_signal_handler(signal.SIGTERM, loop.stop)
+	except NotImplementedError:
+		pass
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	
+	for worker in workers:
+		worker.terminate()
+	for worker in workers:
+		worker.join()
+	os.remove(brokerPath)
+
+def main():
+	parser = argparse.ArgumentParser(description = "Server for nChat, a chat facet within NeosVR.")
+	parser.add_argument("--host", default = "localhost", help = "the address to listen on")
+	parser.add_argument("--port", type = int, default = 32759, help = "the port to listen on")
+	parser.add_argument("--workers", type = int, default = 1, help = "how many worker processes to spread the clients across (more than 1 only works on Linux)")
+	parser.add_argument("--metrics-port", type = int, help = "serve metrics on this port over HTTP, at /metrics (with --workers, each worker uses the next port after the one before it)")
+	parser.add_argument("--asset-port", type = int, help = "serve the emoji, room icons and a sprite atlas of them on this port over HTTP (the atlas needs Pillow)")
+	parser.add_argument("--record", metavar = "FILE", help = "record every frame that clients send to this file, for replay.py (with --workers, each worker records to FILE-<worker>)")
+	parser.add_argument("--history-database", metavar = "FILE", help = "save the message history of the rooms in rooms.json to this SQLite file, so that it survives restarts")
+	parser.add_argument("--verification-endpoint", help = "where to read the cloud variables of users from to verify them (defaults to the Neos API)")
+	parser.add_argument("--handoff", help = argparse.SUPPRESS) # the listening sockets from the old process during a handoff, as file descriptors
+	parser.add_argument("--handoff-ready", type = int, help = argparse.SUPPRESS) # the pipe to tell the old process that this one took over, as a file descriptor
+	options = parser.parse_args()
+	
+	if options.workers > 1:
+		runWorkers(options.workers, options.host, options.port, options.metrics_port, options.asset_port, options.record, options.verification_endpoint, options.history_database)
+	else:
+		runServer(options.host, options.port, metrics = options.metrics_port, assetServerPort = options.asset_port, record = options.record, verificationURL = options.verification_endpoint, historyPath = options.history_database, handoffSockets = [int(fileDescriptor) for fileDescriptor in options.handoff.split(",")] if options.handoff else None, handoffReady = options.handoff_ready)
+
+if __name__ == "__main__":
+	main()